@@ -5,14 +5,28 @@ This module handles authentication with the NICE inContact CXone API.
 It retrieves an access token using the OAuth 2.0 password grant type.
 """
 
-import os
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
-from typing import Dict, Optional
-from dotenv import load_dotenv
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+import config
 
-# Load environment variables from .env file
-load_dotenv()
+# Credentials from the environment (read once; env vars don't change after start)
+_ENV_USERNAME = config.get("CXONE_USERNAME")
+_ENV_PASSWORD = config.get("CXONE_PASSWORD")
+_ENV_CLIENT_ID = config.get("CXONE_CLIENT_ID")
+_ENV_CLIENT_SECRET = config.get("CXONE_CLIENT_SECRET")
+
+# (attribute, environment variable) pairs checked by _validate_credentials
+_REQUIRED_CREDENTIALS = (
+    ("username", "CXONE_USERNAME"),
+    ("password", "CXONE_PASSWORD"),
+    ("client_id", "CXONE_CLIENT_ID"),
+    ("client_secret", "CXONE_CLIENT_SECRET"),
+)
 
 
 class CXoneAuthenticator:
@@ -30,6 +44,15 @@ class CXoneAuthenticator:
         token_expiry (datetime): Token expiration time
     """
     
+    # Process-wide token cache shared by all instances, keyed on
+    # (client_id, username) ->
+    #     (access_token, token_type, token_expiry, expiry_monotonic, refresh_token)
+    _TOKEN_CACHE: Dict[Tuple[str, str], Tuple[str, str, datetime, float, Optional[str]]] = {}
+    # Serializes token renewal so concurrent callers share one auth request
+    _TOKEN_LOCK = threading.RLock()
+    # True when every credential is available from the environment
+    _ENV_OK = all((_ENV_USERNAME, _ENV_PASSWORD, _ENV_CLIENT_ID, _ENV_CLIENT_SECRET))
+    
     def __init__(
         self,
         username: Optional[str] = None,
@@ -49,10 +72,10 @@ class CXoneAuthenticator:
         self.auth_url = "https://cxone.niceincontact.com/auth/token"
         
         # Load credentials from parameters or environment variables
-        self.username = username or os.getenv("CXONE_USERNAME")
-        self.password = password or os.getenv("CXONE_PASSWORD")
-        self.client_id = client_id or os.getenv("CXONE_CLIENT_ID")
-        self.client_secret = client_secret or os.getenv("CXONE_CLIENT_SECRET")
+        self.username = username or _ENV_USERNAME
+        self.password = password or _ENV_PASSWORD
+        self.client_id = client_id or _ENV_CLIENT_ID
+        self.client_secret = client_secret or _ENV_CLIENT_SECRET
         
         # Token storage
         self.access_token: Optional[str] = None
@@ -60,9 +83,23 @@ class CXoneAuthenticator:
         self.id_token: Optional[str] = None
         self.token_type: str = "Bearer"
         self.token_expiry: Optional[datetime] = None
+        # Expiry as a time.monotonic() deadline; cheaper to compare than datetime.now()
+        self._expiry_monotonic: Optional[float] = None
+        # Prebuilt request headers and the access token they were built for
+        self._headers_cache: Optional[Mapping[str, str]] = None
+        self._headers_token: Optional[str] = None
+        
+        # Validate credentials (nothing to check when all come from a complete environment)
+        if not self._ENV_OK or any((username, password, client_id, client_secret)):
+            self._validate_credentials()
         
-        # Validate credentials
-        self._validate_credentials()
+        # Persistent HTTP session so re-authentication reuses the
+        # keep-alive connection instead of a fresh TCP + TLS handshake
+        self._session = requests.Session()
+        self._session.headers.update({
+            "Content-Type": "application/x-www-form-urlencoded"
+        })
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
     
     def _validate_credentials(self) -> None:
         """
@@ -71,15 +108,11 @@ class CXoneAuthenticator:
         Raises:
             ValueError: If any required credential is missing
         """
-        missing = []
-        if not self.username:
-            missing.append("username (CXONE_USERNAME)")
-        if not self.password:
-            missing.append("password (CXONE_PASSWORD)")
-        if not self.client_id:
-            missing.append("client_id (CXONE_CLIENT_ID)")
-        if not self.client_secret:
-            missing.append("client_secret (CXONE_CLIENT_SECRET)")
+        missing = [
+            f"{name} ({env_var})"
+            for name, env_var in _REQUIRED_CREDENTIALS
+            if not getattr(self, name)
+        ]
         
         if missing:
             raise ValueError(
@@ -107,15 +140,10 @@ class CXoneAuthenticator:
             "client_secret": self.client_secret
         }
         
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-        
         try:
-            response = requests.post(
+            response = self._session.post(
                 self.auth_url,
                 data=payload,
-                headers=headers,
                 timeout=30
             )
             
@@ -126,14 +154,7 @@ class CXoneAuthenticator:
             auth_data = response.json()
             
             # Store tokens
-            self.access_token = auth_data.get("access_token")
-            self.refresh_token = auth_data.get("refresh_token")
-            self.id_token = auth_data.get("id_token")
-            self.token_type = auth_data.get("token_type", "Bearer")
-            
-            # Calculate token expiry (subtract 60 seconds as buffer)
-            expires_in = auth_data.get("expires_in", 3600)
-            self.token_expiry = datetime.now() + timedelta(seconds=expires_in - 60)
+            self._store_tokens(auth_data)
             
             print(f"✓ Authentication successful!")
             print(f"  Token expires at: {self.token_expiry.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -158,6 +179,67 @@ class CXoneAuthenticator:
         except (KeyError, ValueError) as e:
             raise ValueError(f"Invalid authentication response: {str(e)}")
     
+    def _refresh(self) -> Dict:
+        """
+        Renew the access token using the refresh_token grant.
+        
+        Cheaper than a full password grant and avoids re-sending the
+        username/password.
+        
+        Returns:
+            Dict containing the refresh response
+        
+        Raises:
+            requests.exceptions.HTTPError: If the refresh token is rejected
+            requests.exceptions.RequestException: If the API request fails
+        """
+        payload = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token,
+            "client_id": self.client_id,
+            "client_secret": self.client_secret
+        }
+        
+        response = self._session.post(
+            self.auth_url,
+            data=payload,
+            timeout=30
+        )
+        response.raise_for_status()
+        
+        auth_data = response.json()
+        self._store_tokens(auth_data)
+        
+        print(f"✓ Token refreshed!")
+        print(f"  Token expires at: {self.token_expiry.strftime('%Y-%m-%d %H:%M:%S')}")
+        
+        return auth_data
+    
+    def _store_tokens(self, auth_data: Dict) -> None:
+        """
+        Store tokens and expiry from an authentication or refresh response.
+        
+        Args:
+            auth_data: Token endpoint response body
+        """
+        self.access_token = auth_data.get("access_token")
+        # Refresh responses may omit these; keep the previous values
+        self.refresh_token = auth_data.get("refresh_token", self.refresh_token)
+        self.id_token = auth_data.get("id_token", self.id_token)
+        self.token_type = auth_data.get("token_type", "Bearer")
+        
+        # Calculate token expiry (subtract 60 seconds as buffer)
+        expires_in = auth_data.get("expires_in", 3600)
+        self._expiry_monotonic = time.monotonic() + (expires_in - 60)
+        # Wall-clock expiry, only used for display
+        self.token_expiry = datetime.now() + timedelta(seconds=expires_in - 60)
+        
+        with self._TOKEN_LOCK:
+            self._TOKEN_CACHE[(self.client_id, self.username)] = (
+                self.access_token, self.token_type, self.token_expiry,
+                self._expiry_monotonic, self.refresh_token
+            )
+    
     def get_access_token(self) -> str:
         """
         Get a valid access token, refreshing if necessary.
@@ -168,9 +250,30 @@ class CXoneAuthenticator:
         Raises:
             Exception: If unable to obtain a valid token
         """
-        # Check if we need to authenticate
-        if not self.access_token or self.is_token_expired():
-            print("Token is expired or not available, authenticating...")
+        if self.access_token and not self.is_token_expired():
+            return self.access_token
+        
+        with self._TOKEN_LOCK:
+            # Reuse a token obtained by another instance (or by a concurrent
+            # caller that held the lock before us)
+            cached = self._TOKEN_CACHE.get((self.client_id, self.username))
+            if cached and time.monotonic() < cached[3]:
+                (self.access_token, self.token_type, self.token_expiry,
+                 self._expiry_monotonic, self.refresh_token) = cached
+                return self.access_token
+            
+            # Check if we need to authenticate
+            if self.refresh_token:
+                print("Token is expired, refreshing...")
+                try:
+                    self._refresh()
+                    return self.access_token
+                except requests.exceptions.HTTPError as e:
+                    if e.response is None or e.response.status_code not in (400, 401):
+                        raise
+                    print("  Refresh token rejected, re-authenticating...")
+            else:
+                print("Token is expired or not available, authenticating...")
             self.authenticate()
         
         return self.access_token
@@ -182,22 +285,33 @@ class CXoneAuthenticator:
         Returns:
             bool: True if token is expired or about to expire, False otherwise
         """
-        if not self.token_expiry:
-            return True
-        
-        return datetime.now() >= self.token_expiry
+        return time.monotonic() >= (self._expiry_monotonic or 0)
     
-    def get_auth_header(self) -> Dict[str, str]:
+    def get_auth_header(self) -> Mapping[str, str]:
         """
         Get the authorization header for API requests.
         
+        The headers are built once per access token and shared between
+        calls, so the returned mapping is read-only; copy it with dict()
+        before adding headers.
+        
         Returns:
-            Dict containing the Authorization header
+            Read-only mapping with the Authorization and JSON accept headers
         """
         token = self.get_access_token()
-        return {
-            "Authorization": f"{self.token_type} {token}"
-        }
+        if token is not self._headers_token:
+            self._headers_cache = MappingProxyType({
+                "Authorization": f"{self.token_type} {token}",
+                "accept": "application/json"
+            })
+            self._headers_token = token
+        return self._headers_cache
+    
+    def close(self) -> None:
+        """
+        Close the underlying HTTP session and release pooled connections.
+        """
+        self._session.close()
 
 
 def main():
@@ -223,7 +337,7 @@ def main():
         
         # Example: Get authorization header for API calls
         print("\nAuthorization Header for API calls:")
-        print(auth.get_auth_header())
+        print(dict(auth.get_auth_header()))
         
     except Exception as e:
         print(f"❌ Error: {str(e)}")
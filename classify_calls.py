@@ -12,31 +12,49 @@ Step 3 of the pipeline:
   3. classify_calls.py → Gemini classification → BigQuery
 """
 
-import os
 import sys
-import time
+import re
 import json
+import time
+import asyncio
+import hashlib
 from datetime import datetime, timezone
-from google.cloud import bigquery
-from dotenv import load_dotenv
+import orjson
+from google import genai
+from google.cloud import bigquery, bigquery_storage
+import config
+
+# Route plain json.loads() calls, including the google-genai SDK's response
+# decoding, through orjson. Calls with extra arguments, and input orjson
+# rejects (e.g. NaN literals), fall back to the stdlib parser.
+_stdlib_json_loads = json.loads
+
+
+def _fast_json_loads(s, *args, **kwargs):
+    if not args and not kwargs:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    return _stdlib_json_loads(s, *args, **kwargs)
 
-# Load environment variables
-load_dotenv()
+
+json.loads = _fast_json_loads
 
 # --- CONFIGURATION ---
-PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-DATASET_ID = os.getenv("GCP_DATASET_ID")
-TRACKING_TABLE_NAME = os.getenv("GCP_TRACKING_TABLE")
-VERTEX_AI_LOCATION = os.getenv("VERTEX_AI_LOCATION", "australia-southeast1")
+PROJECT_ID = config.get("GCP_PROJECT_ID")
+DATASET_ID = config.get("GCP_DATASET_ID")
+TRACKING_TABLE_NAME = config.get("GCP_TRACKING_TABLE")
+VERTEX_AI_LOCATION = config.get("VERTEX_AI_LOCATION", "australia-southeast1")
 
 # Validate required environment variables
-required_vars = {
-    "GCP_PROJECT_ID": PROJECT_ID,
-    "GCP_DATASET_ID": DATASET_ID,
-    "GCP_TRACKING_TABLE": TRACKING_TABLE_NAME,
-}
+required_vars = (
+    ("GCP_PROJECT_ID", PROJECT_ID),
+    ("GCP_DATASET_ID", DATASET_ID),
+    ("GCP_TRACKING_TABLE", TRACKING_TABLE_NAME),
+)
 
-missing_vars = [name for name, value in required_vars.items() if not value]
+missing_vars = [name for name, value in required_vars if not value]
 if missing_vars:
     raise ValueError(
         f"Missing required environment variables: {', '.join(missing_vars)}\n"
@@ -45,78 +63,181 @@ if missing_vars:
 
 TRACKING_TABLE = f"{PROJECT_ID}.{DATASET_ID}.{TRACKING_TABLE_NAME}"
 CLASSIFICATIONS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.call_classifications"
+CACHE_TABLE = f"{PROJECT_ID}.{DATASET_ID}.gemini_classification_cache"
 
 # Gemini config
 GEMINI_MODEL = "gemini-2.0-flash-thinking-exp"
 GEMINI_FALLBACK_MODEL = "gemini-2.0-flash"
 
-# Rate limiting
-SLEEP_BETWEEN_CALLS = 1.0  # seconds between Gemini API calls
+# Longer transcripts are cut in the middle (keeping the first 60% and last
+# 40%) before prompting, to cap Gemini latency and token spend
+MAX_PROMPT_TRANSCRIPT_CHARS = 48000
+
+# Concurrency / rate limiting
+MAX_CONCURRENT_CALLS = 8  # in-flight Gemini requests
+MAX_CALLS_PER_SECOND = 1  # aggregate Gemini QPS across all tasks
+
+# BigQuery writer batching
+WRITE_QUEUE_SIZE = 32  # classified rows waiting for the writer
+WRITE_BATCH_SIZE = 50  # rows per insert_rows_json call
+WRITE_FLUSH_SECONDS = 5.0  # flush a partial batch after this long
+
+
+class RateLimiter:
+    """
+    Limiter that spaces call starts at least 1/qps seconds apart.
+
+    Callers only wait when they arrive faster than the target rate, so
+    no time is spent sleeping while calls already take longer than 1/qps.
+    Shared by tasks on one event loop; the slot is reserved without an
+    await in between, so no lock is needed.
+    """
+
+    def __init__(self, qps):
+        self._min_interval = 1.0 / qps
+        self._next = 0.0
 
+    async def acquire(self):
+        """Wait until the next call is allowed."""
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self._min_interval
+        if start > now:
+            await asyncio.sleep(start - now)
 
-# --- GEMINI CLIENT (lazy loaded) ---
-_genai_client = None
+
+_gemini_limiter = RateLimiter(MAX_CALLS_PER_SECOND)
+
+
+# --- CLIENTS (module-level singletons, shared by all helpers) ---
+_BQ_CLIENT = bigquery.Client(project=PROJECT_ID)
+_BQ_STORAGE_CLIENT = bigquery_storage.BigQueryReadClient()
+_GENAI_CLIENT = genai.Client(
+    vertexai=True,
+    project=PROJECT_ID,
+    location=VERTEX_AI_LOCATION,
+)
 
 
 def get_genai_client():
-    """Lazy-load the Google GenAI client with Vertex AI backend."""
-    global _genai_client
-    if _genai_client is None:
-        try:
-            from google import genai
-            _genai_client = genai.Client(
-                vertexai=True,
-                project=PROJECT_ID,
-                location=VERTEX_AI_LOCATION,
-            )
-            print(f"✓ Gemini client initialized (Vertex AI @ {VERTEX_AI_LOCATION})")
-        except ImportError:
-            raise RuntimeError(
-                "google-genai package not installed. Run: uv add google-genai"
-            )
-        except Exception as e:
-            raise RuntimeError(f"Failed to initialize Gemini client: {e}")
-    return _genai_client
+    """Return the shared Google GenAI client (Vertex AI backend)."""
+    return _GENAI_CLIENT
 
 
 # --- BIGQUERY FUNCTIONS ---
 
 
 def init_bq_client():
-    """Initialize BigQuery client."""
-    return bigquery.Client(project=PROJECT_ID)
+    """Return the shared BigQuery client."""
+    return _BQ_CLIENT
+
+
+def ensure_cache_table(bq_client):
+    """Creates the Gemini classification cache table if it doesn't exist."""
+    schema = [
+        bigquery.SchemaField("hash", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("model", "STRING", mode="NULLABLE"),
+        bigquery.SchemaField("classification", "JSON", mode="NULLABLE"),
+        bigquery.SchemaField("created_at", "TIMESTAMP", mode="NULLABLE"),
+    ]
+    table_ref = bigquery.Table(CACHE_TABLE, schema=schema)
+    try:
+        bq_client.get_table(table_ref)
+        print(f"✓ Cache table {CACHE_TABLE} found.")
+    except Exception:
+        print(f"Creating cache table {CACHE_TABLE}...")
+        bq_client.create_table(table_ref)
+        print(f"✓ Cache table created.")
+
+
+def transcript_hash(transcript_text):
+    """Stable cache key for a transcript (hash the full text, not the prompt copy)."""
+    return hashlib.blake2b(transcript_text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def get_cached_classification(bq_client, cache_key):
+    """
+    Look up a previous Gemini classification for the same transcript.
+    Returns (classification, model_name) or None on a cache miss.
+    """
+    query = f"""
+        SELECT model, classification
+        FROM `{CACHE_TABLE}`
+        WHERE hash = @hash
+        ORDER BY created_at DESC
+        LIMIT 1
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("hash", "STRING", cache_key),
+        ]
+    )
+    rows = list(bq_client.query(query, job_config=job_config).result())
+    if not rows:
+        return None
+
+    classification = rows[0].classification
+    if isinstance(classification, str):
+        classification = orjson.loads(classification)
+    return classification, rows[0].model
+
+
+def save_cached_classification(bq_client, cache_key, classification, model_name):
+    """Store a Gemini classification in the cache table."""
+    row = {
+        "hash": cache_key,
+        "model": model_name,
+        "classification": orjson.dumps(classification).decode(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    errors = bq_client.insert_rows_json(CACHE_TABLE, [row])
+    if errors:
+        print(f"  ⚠ Failed to cache classification: {errors}")
 
 
 def get_pending_classifications(bq_client, limit=None):
     """
     Fetch records that have been transcribed but not yet classified by Gemini.
     Returns list of dicts with contactId and transcription.
+
+    The full transcript is fetched because it is also written to the
+    classifications table; only the prompt copy is truncated (see
+    truncate_transcript).
     """
-    limit_clause = f"LIMIT {limit}" if limit else ""
+    limit_clause = "LIMIT @limit" if limit else ""
+    query_parameters = []
+    if limit:
+        query_parameters.append(bigquery.ScalarQueryParameter("limit", "INT64", limit))
 
+    # Predicates on gemini_analysed / transcribed let BigQuery prune blocks
+    # when the table is clustered on those columns (see README)
     query = f"""
         SELECT contactId, transcription
         FROM `{TRACKING_TABLE}`
-        WHERE transcribed = 1
+        WHERE gemini_analysed IS DISTINCT FROM 1
+          AND transcribed = 1
           AND transcription IS NOT NULL
-          AND LENGTH(TRIM(transcription)) > 0
-          AND (gemini_analysed IS NULL OR gemini_analysed = 0)
+          AND TRIM(transcription) != ''
         ORDER BY fetch_datetime ASC
         {limit_clause}
     """
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
 
     print("Fetching pending classifications from BigQuery...")
-    rows = bq_client.query(query).result()
-    results = [
-        {"contactId": row.contactId, "transcription": row.transcription}
-        for row in rows
-    ]
-    return results
+    # Download via the Storage Read API (Arrow over gRPC) rather than paging
+    # rows through the REST API; long transcripts make this the bulk of the bytes
+    table = bq_client.query(query, job_config=job_config).result().to_arrow(
+        bqstorage_client=_BQ_STORAGE_CLIENT
+    )
+    return table.select(["contactId", "transcription"]).to_pylist()
 
 
-def build_classification_prompt(transcript_text):
-    """Build the Gemini classification prompt with the transcript."""
-    return f"""You are analyzing a customer service call transcript for an Australian outdoor power equipment parts business (chainsawspares.com.au).
+# Matches a response wrapped in a ```json / ``` fence; group 1 is the body
+_FENCE_RE = re.compile(r"\A\s*```(?:json)?\s*\n(.*?)\n```\s*\Z", re.DOTALL)
+
+
+# Static classification prompt, built once; the transcript is appended per call
+_PROMPT_PREFIX = """You are analyzing a customer service call transcript for an Australian outdoor power equipment parts business (chainsawspares.com.au).
 
 Classify the call using the following structure. Think through the classification step-by-step, then return ONLY valid JSON with no markdown formatting.
 
@@ -237,7 +358,7 @@ For each major classification section, provide a confidence score from 0.0 to 1.
 - overall_confidence: Overall confidence in the entire classification
 
 Return your classification as JSON with this exact structure:
-{{
+{
   "classification_version": "v1.0",
   "call_type": [...],
   "sale_result": "...",
@@ -245,66 +366,117 @@ Return your classification as JSON with this exact structure:
   "product_family": "...",
   "product_category_detail": [...],
   "problems_detected": [...],
-  "delivery_tracking": {{
+  "delivery_tracking": {
     "carrier": "...",
     "customer_action": "...",
     "reason_for_call": [...]
-  }},
+  },
   "agent_name": "...",
   "escalation_actions": [...],
-  "confidence_scores": {{
+  "confidence_scores": {
     "call_type_confidence": 0.0,
     "sale_result_confidence": 0.0,
     "product_classification_confidence": 0.0,
     "overall_confidence": 0.0
-  }}
-}}
+  }
+}
 
 If the call is NOT about delivery tracking, set "delivery_tracking" to null.
 If agent name is not identified, set "agent_name" to null.
 If no escalation or callback was mentioned, use ["none"] for escalation_actions.
 
 TRANSCRIPT:
-{transcript_text}"""
+"""
+
+
+def truncate_transcript(transcript_text, max_chars=MAX_PROMPT_TRANSCRIPT_CHARS):
+    """
+    Keep the head and tail of an over-long transcript, dropping the middle.
+
+    Must be given the full transcript so the tail really is the end of the
+    call, where outcomes and callbacks are usually discussed.
+    """
+    if len(transcript_text) <= max_chars:
+        return transcript_text
+
+    head = int(max_chars * 0.6)
+    tail = max_chars - head
+    print(f"  ✂ Transcript truncated from {len(transcript_text)} to {max_chars} chars")
+    return transcript_text[:head] + "\n...[truncated]...\n" + transcript_text[-tail:]
+
+
+def build_classification_prompt(transcript_text):
+    """Build the Gemini classification prompt with the transcript."""
+    return _PROMPT_PREFIX + transcript_text
+
+
+def get_response_text(response):
+    """
+    Return the answer text of a Gemini response.
+
+    Reads the text parts directly rather than via response.text, which
+    model-dumps every part and concatenates them into a new string.
+    """
+    candidates = response.candidates or []
+    content = candidates[0].content if candidates else None
+    if not content or not content.parts:
+        raise ValueError("Gemini returned an empty response")
+
+    texts = [part.text for part in content.parts if part.text and not part.thought]
+    return texts[0] if len(texts) == 1 else "".join(texts)
 
 
-def call_gemini(transcript_text):
+async def call_gemini(transcript_text):
     """
-    Send transcript to Gemini for classification.
+    Send transcript to Gemini for classification (async client).
     
-    Tries the primary model first, falls back to stable model if needed.
+    Returns a cached classification when the same transcript was classified
+    before. Otherwise tries the primary model first, falls back to stable
+    model if needed, and caches the result.
     Returns parsed JSON dict or raises an exception.
     """
+    bq_client = init_bq_client()
+    cache_key = transcript_hash(transcript_text)
+    try:
+        cached = await asyncio.to_thread(get_cached_classification, bq_client, cache_key)
+    except Exception as e:
+        print(f"  ⚠ Cache lookup failed: {e}")
+        cached = None
+    if cached:
+        classification, model_name = cached
+        print(f"  ✓ Cached classification reused (model: {model_name})")
+        return classification, model_name
+
     client = get_genai_client()
-    prompt = build_classification_prompt(transcript_text)
+    prompt = build_classification_prompt(truncate_transcript(transcript_text))
 
     # Try primary model, then fallback
     models_to_try = [GEMINI_MODEL, GEMINI_FALLBACK_MODEL]
 
     for model_name in models_to_try:
         try:
-            response = client.models.generate_content(
+            await _gemini_limiter.acquire()
+            response = await client.aio.models.generate_content(
                 model=model_name,
                 contents=prompt,
             )
-            response_text = response.text.strip()
-
-            # Strip markdown code fences if present
-            if response_text.startswith("```"):
-                # Remove ```json or ``` at start and ``` at end
-                lines = response_text.split("\n")
-                if lines[0].startswith("```"):
-                    lines = lines[1:]
-                if lines and lines[-1].strip() == "```":
-                    lines = lines[:-1]
-                response_text = "\n".join(lines).strip()
-
-            # Parse JSON
-            classification = json.loads(response_text)
+            # Strip markdown code fences if present, then parse JSON
+            response_text = get_response_text(response)
+            fence = _FENCE_RE.match(response_text)
+            if fence:
+                response_text = fence.group(1)
+            classification = orjson.loads(response_text)
             print(f"  ✓ Gemini response received (model: {model_name})")
+
+            try:
+                await asyncio.to_thread(
+                    save_cached_classification, bq_client, cache_key, classification, model_name
+                )
+            except Exception as e:
+                print(f"  ⚠ Failed to cache classification: {e}")
             return classification, model_name
 
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"  ⚠ JSON parse error with {model_name}: {e}")
             print(f"    Raw response (first 200 chars): {response_text[:200]}")
             if model_name == models_to_try[-1]:
@@ -320,93 +492,119 @@ def call_gemini(transcript_text):
     raise RuntimeError("All Gemini models failed")
 
 
-def save_classification(bq_client, contact_id, classification, model_name, transcript_text):
-    """
-    Insert classification results into call_classifications table
-    and update gemini_analysed flag in recording_fetch_status.
-    """
-    # Extract fields from classification JSON
-    call_type = classification.get("call_type", [])
-    sale_result = classification.get("sale_result")
-    no_sale_reasons = classification.get("no_sale_reasons", [])
-    product_family = classification.get("product_family")
-    product_category_detail = classification.get("product_category_detail", [])
-    problems_detected = classification.get("problems_detected", [])
-    escalation_actions = classification.get("escalation_actions", [])
-    agent_name = classification.get("agent_name")
-    confidence_scores = classification.get("confidence_scores", {})
+def build_classification_row(contact_id, classification, model_name, transcript_text):
+    """Convert a Gemini classification into a call_classifications row."""
+    confidence_scores = classification.get("confidence_scores") or {}
     delivery_tracking = classification.get("delivery_tracking")
-    version = classification.get("classification_version", "v1.0")
-
-    def sql_str(val):
-        """Escape a string for SQL, returns NULL if None."""
-        if val is None:
-            return "NULL"
-        # BigQuery uses doubled single quotes for escaping, not backslashes
-        escaped = str(val).replace("'", "''")
-        return f"'{escaped}'"
-
-    def sql_array(arr):
-        """Convert a list to a SQL array literal."""
-        if not arr:
-            return "[]"
-        items = ", ".join(sql_str(v) for v in arr)
-        return f"[{items}]"
+    now = datetime.now(timezone.utc)
 
     # Build delivery_tracking STRUCT or NULL
     if delivery_tracking and isinstance(delivery_tracking, dict):
-        dt_carrier = sql_str(delivery_tracking.get("carrier"))
-        dt_action = sql_str(delivery_tracking.get("customer_action"))
-        dt_reasons = sql_array(delivery_tracking.get("reason_for_call", []))
-        dt_sql = f"STRUCT({dt_carrier} AS carrier, {dt_action} AS customer_action, {dt_reasons} AS reason_for_call)"
+        delivery_tracking_row = {
+            "carrier": delivery_tracking.get("carrier"),
+            "customer_action": delivery_tracking.get("customer_action"),
+            "reason_for_call": delivery_tracking.get("reason_for_call") or [],
+        }
     else:
-        dt_sql = "NULL"
-
-    # Build confidence_scores STRUCT
-    cs = confidence_scores or {}
-    ct_conf = cs.get("call_type_confidence", 0.0)
-    sr_conf = cs.get("sale_result_confidence", 0.0)
-    pc_conf = cs.get("product_classification_confidence", 0.0)
-    ov_conf = cs.get("overall_confidence", 0.0)
-    cs_sql = f"STRUCT({ct_conf} AS call_type_confidence, {sr_conf} AS sale_result_confidence, {pc_conf} AS product_classification_confidence, {ov_conf} AS overall_confidence)"
-
-    insert_query = f"""
-        INSERT INTO `{CLASSIFICATIONS_TABLE}` (
-            call_id, contactId, call_date, transcript,
-            classification_version, classification_timestamp, llm_model,
-            call_type, sale_result, product_family, agent_name,
-            no_sale_reasons, product_category_detail, problems_detected, escalation_actions,
-            delivery_tracking, confidence_scores
-        ) VALUES (
-            {sql_str(contact_id)}, {sql_str(contact_id)}, CURRENT_DATE(), @transcript,
-            {sql_str(version)}, CURRENT_TIMESTAMP(), {sql_str(model_name)},
-            {sql_array(call_type)}, {sql_str(sale_result)}, {sql_str(product_family)}, {sql_str(agent_name)},
-            {sql_array(no_sale_reasons)}, {sql_array(product_category_detail)}, {sql_array(problems_detected)}, {sql_array(escalation_actions)},
-            {dt_sql}, {cs_sql}
-        )
+        delivery_tracking_row = None
+
+    # Native Python types: lists map to REPEATED fields, dicts to STRUCTs
+    row = {
+        "call_id": contact_id,
+        "contactId": contact_id,
+        "call_date": now.date().isoformat(),
+        "transcript": transcript_text,
+        "classification_version": classification.get("classification_version", "v1.0"),
+        "classification_timestamp": now.isoformat(),
+        "llm_model": model_name,
+        "call_type": classification.get("call_type") or [],
+        "sale_result": classification.get("sale_result"),
+        "product_family": classification.get("product_family"),
+        "agent_name": classification.get("agent_name"),
+        "no_sale_reasons": classification.get("no_sale_reasons") or [],
+        "product_category_detail": classification.get("product_category_detail") or [],
+        "problems_detected": classification.get("problems_detected") or [],
+        "escalation_actions": classification.get("escalation_actions") or [],
+        "delivery_tracking": delivery_tracking_row,
+        "confidence_scores": {
+            "call_type_confidence": confidence_scores.get("call_type_confidence", 0.0),
+            "sale_result_confidence": confidence_scores.get("sale_result_confidence", 0.0),
+            "product_classification_confidence": confidence_scores.get("product_classification_confidence", 0.0),
+            "overall_confidence": confidence_scores.get("overall_confidence", 0.0),
+        },
+    }
+    return row
+
+
+def save_classifications(bq_client, rows):
     """
+    Stream a batch of classification rows into the call_classifications table.
+    Returns the contactIds of the rows that were saved.
+
+    The gemini_analysed flag in recording_fetch_status is set separately,
+    in one batched UPDATE at the end of the run (see mark_gemini_analysed).
+    """
+    errors = bq_client.insert_rows_json(CLASSIFICATIONS_TABLE, rows)
+    failed_indexes = {error["index"] for error in errors}
+    for error in errors:
+        contact_id = rows[error["index"]]["contactId"]
+        print(f"  ✗ Failed to save classification for {contact_id}: {error['errors']}")
+
+    saved_ids = [
+        row["contactId"] for i, row in enumerate(rows) if i not in failed_indexes
+    ]
+    print(f"  ✓ {len(saved_ids)} classification(s) saved to call_classifications")
+    return saved_ids
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("transcript", "STRING", transcript_text),
-        ]
-    )
-    bq_client.query(insert_query, job_config=job_config).result()
-    print(f"  ✓ Classification saved to call_classifications")
 
-    # UPDATE gemini_analysed flag
+async def classification_writer(bq_client, queue, classified_ids):
+    """
+    Consume classification rows from the queue and stream them to BigQuery
+    in batches of WRITE_BATCH_SIZE rows, or whatever arrived within
+    WRITE_FLUSH_SECONDS. Saved contactIds are appended to classified_ids.
+    Stops after a None sentinel.
+    """
+    loop = asyncio.get_running_loop()
+    finished = False
+
+    while not finished:
+        batch = []
+        deadline = loop.time() + WRITE_FLUSH_SECONDS
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                row = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                finished = True
+                break
+            batch.append(row)
+
+        if not batch:
+            continue
+        try:
+            classified_ids.extend(await asyncio.to_thread(save_classifications, bq_client, batch))
+        except Exception as e:
+            print(f"  ✗ Failed to save {len(batch)} classification(s): {e}")
+
+
+def mark_gemini_analysed(bq_client, contact_ids):
+    """Set gemini_analysed = 1 for all given contacts in a single UPDATE."""
+    if not contact_ids:
+        return
+
     update_query = f"""
         UPDATE `{TRACKING_TABLE}`
         SET gemini_analysed = 1
-        WHERE contactId = @contact_id
+        WHERE contactId IN UNNEST(@contact_ids)
     """
     update_config = bigquery.QueryJobConfig(
         query_parameters=[
-            bigquery.ScalarQueryParameter("contact_id", "STRING", contact_id),
+            bigquery.ArrayQueryParameter("contact_ids", "STRING", contact_ids),
         ]
     )
     bq_client.query(update_query, job_config=update_config).result()
-    print(f"  ✓ recording_fetch_status updated (gemini_analysed=1)")
+    print(f"✓ recording_fetch_status updated (gemini_analysed=1 for {len(contact_ids)} call(s))")
 
 
 def save_classification_error(bq_client, contact_id, error_msg):
@@ -419,11 +617,51 @@ def save_classification_error(bq_client, contact_id, error_msg):
 # --- MAIN ---
 
 
-def main():
+async def process_one(bq_client, semaphore, queue, record, index, total):
+    """
+    Classify a single call and hand the result to the BigQuery writer.
+    Returns True if the call was classified, False on failure.
+    """
+    contact_id = record["contactId"]
+    transcription = record["transcription"]
+
+    async with semaphore:
+        print(f"\n{'=' * 70}")
+        print(f"[{index}/{total}] Contact: {contact_id}")
+        print(f"  Transcript length: {len(transcription)} chars")
+        print("=" * 70)
+
+        try:
+            # Step 1: Call Gemini API
+            print(f"  ⏳ [{contact_id}] Sending to Gemini for classification...")
+            classification, model_used = await call_gemini(transcription)
+
+            # Show preview
+            print(f"  📋 [{contact_id}] Call type: {classification.get('call_type', [])}")
+            print(f"  💰 [{contact_id}] Sale result: {classification.get('sale_result', 'N/A')}")
+            print(f"  🏷️ [{contact_id}] Product: {classification.get('product_family', 'N/A')}")
+            print(f"  👤 [{contact_id}] Agent: {classification.get('agent_name', 'N/A')}")
+            confidence = classification.get("confidence_scores", {})
+            print(f"  🎯 [{contact_id}] Confidence: {confidence.get('overall_confidence', 'N/A')}")
+
+            # Step 2: Queue for the BigQuery writer
+            row = build_classification_row(contact_id, classification, model_used, transcription)
+            await queue.put(row)
+
+            print(f"  ✅ [{contact_id}] Classified, queued for BigQuery")
+            return True
+
+        except Exception as e:
+            save_classification_error(bq_client, contact_id, str(e))
+            return False
+
+
+async def main():
     print("=" * 70)
     print("CXone Call Classification Pipeline (Gemini AI)")
     print("=" * 70)
     print(f"Model: {GEMINI_MODEL} (fallback: {GEMINI_FALLBACK_MODEL})")
+    print(f"Concurrency: {MAX_CONCURRENT_CALLS} (max {MAX_CALLS_PER_SECOND} call(s)/sec)")
     print(f"Vertex AI: {VERTEX_AI_LOCATION}")
     print(f"Tracking: {TRACKING_TABLE}")
     print(f"Output:   {CLASSIFICATIONS_TABLE}")
@@ -431,9 +669,9 @@ def main():
 
     # Initialize clients
     bq_client = init_bq_client()
+    ensure_cache_table(bq_client)
 
-    # Initialize Gemini (fail fast if misconfigured)
-    get_genai_client()
+    print(f"✓ Gemini client initialized (Vertex AI @ {VERTEX_AI_LOCATION})")
 
     # Get pending classifications
     pending = get_pending_classifications(bq_client, limit=10)
@@ -444,52 +682,26 @@ def main():
         print("No pending classifications. Exiting.")
         return
 
-    processed = 0
-    success_count = 0
-    failed_count = 0
-
-    for record in pending:
-
-        # for testing lets do only 1 call
-        # if processed >= 1:
-        #     break
-
-        processed += 1
-        contact_id = record["contactId"]
-        transcription = record["transcription"]
-
-        print(f"\n{'=' * 70}")
-        print(f"[{processed}/{len(pending)}] Contact: {contact_id}")
-        print(f"  Transcript length: {len(transcription)} chars")
-        print("=" * 70)
-
-        try:
-            # Step 1: Call Gemini API
-            print("  ⏳ Sending to Gemini for classification...")
-            classification, model_used = call_gemini(transcription)
-
-            # Show preview
-            print(f"  📋 Call type: {classification.get('call_type', [])}")
-            print(f"  💰 Sale result: {classification.get('sale_result', 'N/A')}")
-            print(f"  🏷️ Product: {classification.get('product_family', 'N/A')}")
-            print(f"  👤 Agent: {classification.get('agent_name', 'N/A')}")
-            confidence = classification.get("confidence_scores", {})
-            print(f"  🎯 Confidence: {confidence.get('overall_confidence', 'N/A')}")
-
-            # Step 2: Save to BigQuery
-            print("  ⏳ Saving to BigQuery...")
-            save_classification(bq_client, contact_id, classification, model_used, transcription)
-
-            success_count += 1
-            print(f"  ✅ Done!")
-
-        except Exception as e:
-            save_classification_error(bq_client, contact_id, str(e))
-            failed_count += 1
-
-        # Rate limiting
-        if processed < len(pending):
-            time.sleep(SLEEP_BETWEEN_CALLS)
+    # Gemini tasks produce rows; a single writer task batches them into BigQuery
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+    queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    classified_ids = []
+    writer = asyncio.create_task(classification_writer(bq_client, queue, classified_ids))
+    try:
+        await asyncio.gather(*[
+            process_one(bq_client, semaphore, queue, record, i, len(pending))
+            for i, record in enumerate(pending, 1)
+        ])
+    finally:
+        await queue.put(None)
+        await writer
+        # Flag every saved classification in one DML job, even if the run is
+        # interrupted, so the next run doesn't classify them again
+        mark_gemini_analysed(bq_client, classified_ids)
+
+    processed = len(pending)
+    success_count = len(classified_ids)
+    failed_count = processed - success_count
 
     # Final Summary
     print(f"\n{'=' * 70}")
@@ -502,4 +714,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
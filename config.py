@@ -0,0 +1,27 @@
+"""
+Shared Configuration
+
+Reads the .env file once per process and merges it with the real environment
+(real environment variables win). Import this module instead of calling
+load_dotenv() in each script.
+"""
+
+import os
+from typing import Dict, Optional
+from dotenv import dotenv_values
+
+_DOTENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+
+_DOTENV = {k: v for k, v in dotenv_values(_DOTENV_PATH).items() if v is not None}
+
+# Values the Google client libraries read straight from os.environ
+# (e.g. GOOGLE_APPLICATION_CREDENTIALS) still need to be visible there
+for _key, _value in _DOTENV.items():
+    os.environ.setdefault(_key, _value)
+
+ENV: Dict[str, str] = {**_DOTENV, **os.environ}
+
+
+def get(name: str, default: Optional[str] = None) -> Optional[str]:
+    """Return a configuration value, or default if it is not set."""
+    return ENV.get(name, default)
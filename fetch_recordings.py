@@ -5,13 +5,41 @@ This module fetches call recording metadata and downloads audio files
 from the CXone Media Playback API.
 """
 
-import os
+import re
+import sys
 import json
 import base64
+import posixpath
+import functools
+import aiohttp
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from urllib3.util.retry import Retry
 from pathlib import Path
-from typing import Dict, Optional, List
+from urllib.parse import urlsplit
+from typing import Dict, Mapping, Optional, List, Tuple
 from auth import CXoneAuthenticator
+import config
+
+
+# Download buffer size and how often download_recording reports progress
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+PROGRESS_INTERVAL_BYTES = 10 << 20  # 10 MiB
+
+# Largest recording stream_to_gcs pipes straight into GCS; this is
+# google-cloud-storage's multipart limit, above which uploads are resumable
+STREAM_UPLOAD_MAX_BYTES = 8 << 20  # 8 MiB
+
+# Set CXONE_VERBOSE to dump full metadata responses (noisy for batch runs)
+VERBOSE = bool(config.get("CXONE_VERBOSE"))
+
+# Detected API area per tenant, persisted across runs
+BASE_URL_CACHE_FILE = Path.home() / ".cxone_base_url"
+
+_ISS_RE = re.compile(rb'"iss"\s*:\s*"([^"]+)"')
+_TENANT_RE = re.compile(rb'"tenantId"\s*:\s*"([^"]+)"')
 
 
 class RecordingNotFoundException(Exception):
@@ -19,6 +47,100 @@ class RecordingNotFoundException(Exception):
     pass
 
 
+class RateLimitedException(requests.exceptions.RequestException):
+    """Raised when the API answers 429 Too Many Requests."""
+    
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds; HTTP-dates are ignored."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+@functools.lru_cache(maxsize=8)
+def _decode_jwt_payload(token: str) -> Dict:
+    """
+    Decode the payload segment of a JWT (no signature verification).
+    
+    Results are cached per token string, so repeated lookups on the same
+    token skip the base64 and JSON decoding. Callers must not mutate the
+    returned dict.
+    """
+    # JWT format: header.payload.signature
+    return json.loads(_b64url_segment(token, 1))
+
+
+def _b64url_segment(token: str, index: int) -> bytes:
+    """Base64url-decode one dot-separated JWT segment."""
+    part = token.split('.')[index]
+    # Add padding if needed
+    padding = len(part) % 4
+    if padding:
+        part += '=' * (4 - padding)
+    return base64.urlsafe_b64decode(part)
+
+
+def _area_cache_key(token: str) -> Optional[str]:
+    """
+    Build the area cache key from the 'tenantId' and 'iss' claims.
+    
+    The claims are found by scanning the decoded payload, without a JSON
+    parse. The issuer is shared across tenants, so tokens without a
+    tenantId get no key and are never cached.
+    """
+    payload = _b64url_segment(token, 1)
+    tenant = _TENANT_RE.search(payload)
+    issuer = _ISS_RE.search(payload)
+    if not tenant or not issuer:
+        return None
+    return f"{tenant.group(1).decode()}@{issuer.group(1).decode()}"
+
+
+def _load_cached_areas() -> Dict[str, str]:
+    """Load the tenant -> area map from BASE_URL_CACHE_FILE ({} if missing or unreadable)."""
+    try:
+        return json.loads(BASE_URL_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cached_area(cache_key: str, area: str) -> None:
+    """Remember the area for a tenant; failures to write are ignored."""
+    areas = _load_cached_areas()
+    areas[cache_key] = area
+    try:
+        BASE_URL_CACHE_FILE.write_text(json.dumps(areas))
+    except OSError:
+        pass
+
+
+def _error_detail(body: bytes) -> Dict:
+    """Parse an error response body once; non-JSON bodies become {'message': <text>}."""
+    try:
+        detail = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return {"message": body.decode("utf-8", "replace")[:512]}
+    return detail if isinstance(detail, dict) else {"message": str(detail)}
+
+
+def _not_found_message(contact_id: str, api_message: str) -> str:
+    """Build the user-facing message for a contact with no recording."""
+    return (
+        f"\n⚠️  Recording not found for contact ID: {contact_id}\n"
+        f"   This contact either:\n"
+        f"   - Doesn't exist in the system\n"
+        f"   - Doesn't have a recording\n"
+        f"   - Recording has expired or been deleted\n"
+        f"   \n"
+        f"   API Response: {api_message}"
+    )
+
 
 class RecordingFetcher:
     """
@@ -42,6 +164,20 @@ class RecordingFetcher:
         self.recordings_dir = Path(recordings_dir)
         self.base_url = None
         
+        # Persistent session so metadata calls and downloads reuse pooled
+        # keep-alive connections; transient 429/5xx responses are retried
+        self._session = requests.Session()
+        retries = Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+        self._session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+        )
+        
         # Create recordings directory if it doesn't exist
         self.recordings_dir.mkdir(exist_ok=True)
         
@@ -60,21 +196,22 @@ class RecordingFetcher:
         if not id_token:
             raise ValueError("No id_token in authentication response")
         
-        # JWT format: header.payload.signature
         try:
-            payload_part = id_token.split('.')[1]
-            # Add padding if needed
-            padding = len(payload_part) % 4
-            if padding:
-                payload_part += '=' * (4 - padding)
-            
-            payload = json.loads(base64.b64decode(payload_part))
-            
-            # Extract 'area' field (e.g., 'au1')
-            area = payload.get("area", "")
+            # Reuse the area seen for this tenant on a previous run, if any
+            cache_key = _area_cache_key(id_token)
+            area = _load_cached_areas().get(cache_key) if cache_key else None
             
             if not area:
-                raise ValueError("'area' field not found in token payload")
+                payload = _decode_jwt_payload(id_token)
+                
+                # Extract 'area' field (e.g., 'au1')
+                area = payload.get("area", "")
+                
+                if not area:
+                    raise ValueError("'area' field not found in token payload")
+                
+                if cache_key:
+                    _save_cached_area(cache_key, area)
             
             # Construct base URL
             self.base_url = f"https://api-{area}.niceincontact.com/media-playback/v1"
@@ -85,6 +222,29 @@ class RecordingFetcher:
         except Exception as e:
             raise ValueError(f"Failed to extract area from token: {str(e)}")
     
+    def _metadata_request(
+        self,
+        contact_id: str,
+        is_download: bool,
+        media_type: str,
+        exclude_waveforms: bool,
+        exclude_qm_categories: bool
+    ) -> Tuple[str, Mapping[str, str], Dict[str, str]]:
+        """Build the endpoint, headers and query parameters for a metadata request."""
+        endpoint = f"{self.base_url}/contacts"
+        
+        # Cached per token; already includes accept: application/json
+        headers = self.authenticator.get_auth_header()
+        
+        params = {
+            "acd-call-id": contact_id,
+            "media-type": media_type,
+            "exclude-waveforms": str(exclude_waveforms).lower(),
+            "exclude-qm-categories": str(exclude_qm_categories).lower(),
+            "isDownload": str(is_download).lower()
+        }
+        return endpoint, headers, params
+    
     def get_recording_metadata(
         self,
         contact_id: str,
@@ -109,25 +269,16 @@ class RecordingFetcher:
         Raises:
             requests.exceptions.RequestException: If the API request fails
         """
-        endpoint = f"{self.base_url}/contacts"
-        
-        headers = self.authenticator.get_auth_header()
-        headers["accept"] = "application/json"
-        
-        params = {
-            "acd-call-id": contact_id,
-            "media-type": media_type,
-            "exclude-waveforms": str(exclude_waveforms).lower(),
-            "exclude-qm-categories": str(exclude_qm_categories).lower(),
-            "isDownload": str(is_download).lower()
-        }
+        endpoint, headers, params = self._metadata_request(
+            contact_id, is_download, media_type, exclude_waveforms, exclude_qm_categories
+        )
         
         print(f"\n🔍 Fetching recording metadata for contact ID: {contact_id}")
         print(f"  URL: {endpoint}")
         print(f"  Parameters: {params}")
         
         try:
-            response = requests.get(
+            response = self._session.get(
                 endpoint,
                 headers=headers,
                 params=params,
@@ -135,47 +286,109 @@ class RecordingFetcher:
             )
             
             response.raise_for_status()
-            metadata = response.json()
+            metadata = orjson.loads(response.content)
             
             print(f"✓ Successfully retrieved metadata")
             
             return metadata
             
         except requests.exceptions.HTTPError as e:
+            # Read and parse the error body once for both cases below
+            error_detail = _error_detail(e.response.content) if e.response is not None else {}
+            
             # Handle 404 specifically - recording not found
             if e.response is not None and e.response.status_code == 404:
-                error_detail = {}
-                try:
-                    error_detail = e.response.json()
-                except:
-                    pass
-                
-                error_msg = (
-                    f"\n⚠️  Recording not found for contact ID: {contact_id}\n"
-                    f"   This contact either:\n"
-                    f"   - Doesn't exist in the system\n"
-                    f"   - Doesn't have a recording\n"
-                    f"   - Recording has expired or been deleted\n"
-                    f"   \n"
-                    f"   API Response: {error_detail.get('message', 'Not found')}"
+                raise RecordingNotFoundException(
+                    _not_found_message(contact_id, error_detail.get('message', 'Not found'))
                 )
-                raise RecordingNotFoundException(error_msg)
             
             # Handle other HTTP errors
-            error_msg = f"HTTP Error fetching metadata: {e}"
-            if e.response is not None:
-                try:
-                    error_detail = e.response.json()
-                    error_msg += f"\nDetails: {error_detail}"
-                except:
-                    error_msg += f"\nResponse: {e.response.text}"
-            raise requests.exceptions.RequestException(error_msg)
+            raise requests.exceptions.RequestException(
+                f"HTTP Error fetching metadata: {e}\nDetails: {error_detail}"
+            )
+        
+        except orjson.JSONDecodeError as e:
+            raise requests.exceptions.RequestException(
+                f"Invalid JSON in metadata response: {str(e)}"
+            )
         
         except requests.exceptions.RequestException as e:
             raise requests.exceptions.RequestException(
                 f"Failed to fetch metadata: {str(e)}"
             )
     
+    async def _get_metadata_async(
+        self,
+        session: aiohttp.ClientSession,
+        contact_id: str,
+        is_download: bool = False,
+        media_type: str = "all",
+        exclude_waveforms: bool = True,
+        exclude_qm_categories: bool = False
+    ) -> Dict:
+        """
+        Async variant of get_recording_metadata using a shared aiohttp session.
+        
+        Args:
+            session: aiohttp.ClientSession shared across concurrent requests
+            contact_id: The contact/ACD call ID
+            is_download: Set to True to get downloadable URL (default: False)
+            media_type: Filter by media type: 'all', 'voice-only', 'voice-and-screen'
+            exclude_waveforms: Exclude waveform data (default: True)
+            exclude_qm_categories: Exclude QM categories (default: False)
+        
+        Returns:
+            Dict containing the API response with recording metadata
+        
+        Raises:
+            RecordingNotFoundException: If the API returns 404 for the contact
+            RateLimitedException: If the API returns 429 (carries Retry-After)
+            requests.exceptions.RequestException: If the API request fails
+        """
+        endpoint, headers, params = self._metadata_request(
+            contact_id, is_download, media_type, exclude_waveforms, exclude_qm_categories
+        )
+        
+        print(f"🔍 [{contact_id}] Fetching recording metadata")
+        
+        try:
+            async with session.get(
+                endpoint,
+                headers=headers,
+                params=params,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                if response.status == 404:
+                    error_detail = _error_detail(await response.read())
+                    raise RecordingNotFoundException(
+                        _not_found_message(contact_id, error_detail.get('message', 'Not found'))
+                    )
+                
+                if response.status == 429:
+                    raise RateLimitedException(
+                        f"Rate limited fetching metadata for contact ID: {contact_id}",
+                        _parse_retry_after(response.headers.get("Retry-After"))
+                    )
+                
+                if response.status >= 400:
+                    error_detail = _error_detail(await response.read())
+                    raise requests.exceptions.RequestException(
+                        f"HTTP Error fetching metadata: {response.status} {response.reason}"
+                        f"\nDetails: {error_detail}"
+                    )
+                
+                return orjson.loads(await response.read())
+        
+        except (aiohttp.ClientError, TimeoutError) as e:
+            raise requests.exceptions.RequestException(
+                f"Failed to fetch metadata: {str(e)}"
+            )
+        
+        except orjson.JSONDecodeError as e:
+            raise requests.exceptions.RequestException(
+                f"Invalid JSON in metadata response: {str(e)}"
+            )
+    
     def extract_file_urls(self, metadata: Dict) -> List[Dict[str, str]]:
         """
         Extract fileToPlayUrl from metadata response.
@@ -208,6 +421,20 @@ class RecordingFetcher:
         
         return file_urls
     
+    def recording_filename(self, file_url: str, contact_id: str, media_type: str) -> str:
+        """Filename for a recording: {contact_id}_{media_type}{ext}."""
+        # Determine file extension from the URL path (ignoring the query) or default to .mp3
+        file_ext = posixpath.splitext(urlsplit(file_url).path)[1]
+        if len(file_ext) < 2:
+            file_ext = ".mp3"
+        
+        # Create filename with contact_id prefix
+        return f"{contact_id}_{media_type}{file_ext}"
+    
+    def _recording_path(self, file_url: str, contact_id: str, media_type: str) -> Path:
+        """Local path for a recording in recordings_dir."""
+        return self.recordings_dir / self.recording_filename(file_url, contact_id, media_type)
+    
     def download_recording(
         self,
         file_url: str,
@@ -228,16 +455,8 @@ class RecordingFetcher:
         Raises:
             requests.exceptions.RequestException: If download fails
         """
-        # Determine file extension from URL or default to .mp3
-        file_ext = ".mp3"
-        if "." in file_url.split("/")[-1]:
-            url_part = file_url.split(".")[-1].split("?")[0]
-            if url_part:
-                file_ext = "." + url_part
-        
-        # Create filename with contact_id prefix
-        filename = f"{contact_id}_{media_type}{file_ext}"
-        filepath = self.recordings_dir / filename
+        filepath = self._recording_path(file_url, contact_id, media_type)
+        filename = filepath.name
         
         print(f"\n📥 Downloading recording...")
         print(f"  File: {filename}")
@@ -245,42 +464,101 @@ class RecordingFetcher:
         
         try:
             # Stream download for large files
-            response = requests.get(file_url, stream=True, timeout=60)
-            response.raise_for_status()
-            
-            # Get file size if available
-            total_size = int(response.headers.get('content-length', 0))
-            
-            # Download in chunks
-            chunk_size = 8192
-            downloaded = 0
-            last_logged_percent = -1
-            
-            with open(filepath, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=chunk_size):
-                    if chunk:
+            with self._session.get(file_url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                
+                # Get file size if available
+                total_size = int(response.headers.get('content-length', 0))
+                
+                # Read straight from the raw stream in 1 MiB chunks (urllib3's
+                # readinto() just copies read() output, so it saves nothing)
+                downloaded = 0
+                next_progress = PROGRESS_INTERVAL_BYTES
+                
+                # Progress lines only help an interactive terminal; in Cloud Run
+                # or cron logs they are just noise
+                show_progress = sys.stdout.isatty()
+                
+                with open(filepath, 'wb') as f:
+                    while chunk := response.raw.read(DOWNLOAD_CHUNK_SIZE):
                         f.write(chunk)
                         downloaded += len(chunk)
                         
-                        # Show progress only at 25% intervals to reduce logging
-                        if total_size > 0:
-                            progress = (downloaded / total_size) * 100
-                            # Only log at 0%, 25%, 50%, 75%, 100%
-                            current_percent_milestone = int(progress / 25) * 25
-                            if current_percent_milestone != last_logged_percent and current_percent_milestone in [0, 25, 50, 75, 100]:
-                                print(f"  Progress: {progress:.1f}% ({downloaded:,}/{total_size:,} bytes)")
-                                last_logged_percent = current_percent_milestone
+                        # Show progress every PROGRESS_INTERVAL_BYTES to reduce logging
+                        if show_progress and downloaded >= next_progress:
+                            if total_size > 0:
+                                print(f"\r  Progress: {downloaded / total_size:.1%} ({downloaded:,}/{total_size:,} bytes)", end="", flush=True)
+                            else:
+                                print(f"\r  Progress: {downloaded:,} bytes", end="", flush=True)
+                            next_progress += PROGRESS_INTERVAL_BYTES
             
             print(f"\n✓ Successfully downloaded: {filepath}")
             print(f"  File size: {downloaded:,} bytes")
             
             return filepath
             
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, Urllib3HTTPError) as e:
             raise requests.exceptions.RequestException(
                 f"Failed to download recording: {str(e)}"
             )
     
+    def stream_to_gcs(self, file_url: str, blob, contact_id: str, media_type: str = "voice") -> int:
+        """
+        Stream a recording from the provided URL straight into a GCS blob.
+        
+        The HTTP response body is piped into the upload, so nothing is
+        written to local disk. That is only safe for a single-request
+        upload of a known size: larger or unsized uploads are resumable,
+        and retrying a chunk seeks the stream, which an HTTP response
+        can't do. Those recordings are downloaded to recordings_dir with
+        download_recording, uploaded from the file, and the file removed.
+        
+        Args:
+            file_url: The URL to download the file from
+            blob: google.cloud.storage.Blob to upload into
+            contact_id: Contact ID, used for the fallback download's filename
+            media_type: Type of media for the fallback filename (default: 'voice')
+        
+        Returns:
+            Number of bytes read from the download
+        
+        Raises:
+            requests.exceptions.RequestException: If download fails
+        """
+        try:
+            with self._session.get(file_url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                content_type = response.headers.get("content-type", "audio/mpeg")
+                
+                # content-length is only the body size when it isn't compressed
+                size = None
+                if "content-length" in response.headers and "content-encoding" not in response.headers:
+                    size = int(response.headers["content-length"])
+                
+                if size is not None and size <= STREAM_UPLOAD_MAX_BYTES:
+                    blob.upload_from_file(response.raw, size=size, content_type=content_type)
+                    return response.raw.tell()
+        
+        # Errors while the upload reads response.raw (ProtocolError,
+        # ReadTimeoutError) surface as raw urllib3 exceptions
+        except (requests.exceptions.RequestException, Urllib3HTTPError) as e:
+            raise requests.exceptions.RequestException(
+                f"Failed to download recording: {str(e)}"
+            )
+        
+        filepath = self.download_recording(file_url, contact_id, media_type)
+        try:
+            blob.upload_from_filename(str(filepath), content_type=content_type)
+            return filepath.stat().st_size
+        finally:
+            filepath.unlink(missing_ok=True)
+    
+    def close(self) -> None:
+        """Close the underlying HTTP session and its pooled connections."""
+        self._session.close()
+    
     def fetch_and_download(self, contact_id: str) -> List[Path]:
         """
         Fetch metadata and download all recordings for a contact ID.
@@ -297,8 +575,9 @@ class RecordingFetcher:
             # Get metadata
             metadata = self.get_recording_metadata(contact_id)
             
-            print(f"\n📋 Metadata Response:")
-            print(json.dumps(metadata, indent=2))
+            if VERBOSE:
+                print(f"\n📋 Metadata Response:")
+                print(json.dumps(metadata, indent=2))
             
             # Extract file URLs
             file_urls = self.extract_file_urls(metadata)
@@ -1,27 +1,28 @@
-import os
 import time
-import json
-import pandas as pd
+import pickle
+import asyncio
+import threading
+import aiohttp
+import orjson
 from google.cloud import bigquery
 from google.cloud import storage
+from google.api_core.exceptions import BadRequest
 from datetime import datetime, timezone
 from pathlib import Path
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
 
 # Import your existing classes
+import config
 from auth import CXoneAuthenticator
-from fetch_recordings import RecordingFetcher, RecordingNotFoundException
+from fetch_recordings import RecordingFetcher, RecordingNotFoundException, RateLimitedException
 
 # --- CONFIGURATION FROM ENVIRONMENT ---
-PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-DATASET_ID = os.getenv("GCP_DATASET_ID")
-SOURCE_TABLE_NAME = os.getenv("GCP_SOURCE_TABLE")
-TRACKING_TABLE_NAME = os.getenv("GCP_TRACKING_TABLE")
-BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
-CUTOFF_DATE = os.getenv("CUTOFF_DATE")  # Optional: e.g. "2026-02-16" — skip contacts before this date
+PROJECT_ID = config.get("GCP_PROJECT_ID")
+DATASET_ID = config.get("GCP_DATASET_ID")
+SOURCE_TABLE_NAME = config.get("GCP_SOURCE_TABLE")
+TRACKING_TABLE_NAME = config.get("GCP_TRACKING_TABLE")
+BUCKET_NAME = config.get("GCS_BUCKET_NAME")
+CUTOFF_DATE = config.get("CUTOFF_DATE")  # Optional: e.g. "2026-02-16" — skip contacts before this date
+DEBUG_JSON = bool(config.get("DEBUG_JSON"))  # Optional: pretty-print raw_response for ad-hoc debugging
 
 # Validate required environment variables
 required_vars = {
@@ -46,8 +47,71 @@ TRACKING_TABLE = f"{PROJECT_ID}.{DATASET_ID}.{TRACKING_TABLE_NAME}"
 if CUTOFF_DATE:
     print(f"📅 Cutoff date set: {CUTOFF_DATE} (skipping contacts before this date)")
 
-# API Rate Limit Buffer (Seconds)
-SLEEP_TIME = 1.5  # Adjust based on your API tier
+# CXone API rate limit (metadata requests per second). The limiter starts at
+# the max, halves its rate on every 429 and creeps back up while calls succeed.
+MAX_REQUESTS_PER_SECOND = 8  # Adjust based on your API tier
+MIN_REQUESTS_PER_SECOND = 0.5
+RATE_INCREASE_STEP = 0.1
+MAX_RATE_LIMIT_RETRIES = 5
+
+# Contacts processed at the same time (metadata fetch, download and upload overlap)
+MAX_CONCURRENT_CONTACTS = 16
+
+# Recordings are streamed from CXone into GCS by separate workers fed by a
+# bounded queue (see stream_to_gcs for when a local file is used instead)
+UPLOAD_WORKERS = 8
+UPLOAD_QUEUE_SIZE = 32
+
+# Tracking rows are buffered and written with one INSERT per batch
+TRACKING_FLUSH_SIZE = 500
+TRACKING_FLUSH_SECONDS = 30
+
+# Local checkpoint of processed contacts, so later runs only scan new source rows.
+# Delete the file to force a full scan against the tracking table.
+CHECKPOINT_FILE = Path(".cxone_processed.pkl")
+
+_tracking_buffer = []
+_tracking_rejected = []  # rows BigQuery refused outright; never retried this run
+_tracking_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+class AdaptiveRateLimiter:
+    """
+    Limiter that spaces request starts at least 1/qps seconds apart, with AIMD.
+
+    Callers only wait when they arrive faster than the current rate. A 429
+    halves the rate and pauses new requests for the server's Retry-After;
+    every success raises the rate by RATE_INCREASE_STEP up to the maximum.
+    Shared by tasks on one event loop; the slot is reserved without an
+    await in between, so no lock is needed.
+    """
+
+    def __init__(self, max_qps, min_qps):
+        self._max_qps = max_qps
+        self._min_qps = min_qps
+        self._qps = max_qps
+        self._next = 0.0
+
+    async def acquire(self):
+        """Wait until the next request is allowed."""
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + 1.0 / self._qps
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def on_success(self):
+        """Additively raise the rate after a request that wasn't throttled."""
+        self._qps = min(self._max_qps, self._qps + RATE_INCREASE_STEP)
+
+    def on_rate_limited(self, retry_after=None):
+        """Halve the rate and hold new requests for retry_after seconds."""
+        self._qps = max(self._min_qps, self._qps / 2)
+        delay = retry_after if retry_after is not None else 1.0 / self._qps
+        self._next = max(self._next, time.monotonic() + delay)
+        print(f"  ⏳ Rate limited by CXone API; slowing to {self._qps:.2f} req/s")
+
+RAW_RESPONSE_JSON_OPTION = orjson.OPT_INDENT_2 if DEBUG_JSON else 0
 
 def init_clients():
     """Initialize BigQuery and Cloud Storage clients."""
@@ -84,63 +148,325 @@ def ensure_tracking_table(bq_client):
         bq_client.create_table(table_ref)
         print(f"✓ Tracking table created.")
 
-def get_pending_contacts(bq_client, limit=None):
+def load_checkpoint():
+    """
+    Load the local checkpoint written by the previous run.
+
+    Returns a dict with "watermark" (newest source startDate fully processed,
+    or None for a full scan) and "processed_ids" (contacts already handled
+    at or after the watermark).
+    """
+    try:
+        with open(CHECKPOINT_FILE, "rb") as f:
+            checkpoint = pickle.load(f)
+        print(f"✓ Loaded checkpoint: {len(checkpoint['processed_ids'])} processed contacts, "
+              f"watermark {checkpoint['watermark']}")
+        return checkpoint
+    except FileNotFoundError:
+        return {"watermark": None, "processed_ids": set()}
+    except Exception as e:
+        print(f"⚠ Ignoring unreadable checkpoint {CHECKPOINT_FILE}: {e}")
+        return {"watermark": None, "processed_ids": set()}
+
+def save_checkpoint(checkpoint):
+    """Write the checkpoint atomically (temp file + rename)."""
+    tmp_path = CHECKPOINT_FILE.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path.replace(CHECKPOINT_FILE)
+
+def get_source_watermark(bq_client):
+    """Return the newest startDate currently in the source table."""
+    query = f"SELECT MAX(startDate) AS newest FROM `{SOURCE_TABLE}`"
+    for row in bq_client.query(query).result():
+        return row.newest
+    return None
+
+def get_contact_ids_since(bq_client, since):
+    """Return the IDs of source contacts with startDate >= since."""
+    query = f"""
+        SELECT CAST(src.contactId AS STRING) as contactId
+        FROM `{SOURCE_TABLE}` src
+        WHERE src.startDate >= '{since}'
+    """
+    rows = bq_client.query(query).result(page_size=10000)
+    return {row.contactId for row in rows}
+
+def get_pending_contacts(bq_client, limit=None, since=None, exclude=frozenset()):
     """
     Fetches contacts from source that are NOT in the tracking table.
     
     Args:
         bq_client: BigQuery client
         limit: Optional limit for testing (e.g., 10 for first batch)
+        since: Optional checkpoint watermark; when set, only source rows with
+            startDate >= since are read (no join against the tracking table)
+        exclude: Contact IDs already processed, filtered out client-side
     """
-    limit_clause = f"LIMIT {limit}" if limit else ""
     cutoff_clause = f"AND src.startDate >= '{CUTOFF_DATE}'" if CUTOFF_DATE else ""
     
-    # Cast contactId to STRING to match tracking table type
+    if since is not None:
+        # Everything older than the watermark was fully processed by an
+        # earlier run, so read just the new rows and drop known IDs locally
+        limit_clause = f"LIMIT {limit + len(exclude)}" if limit else ""
+        query = f"""
+            SELECT CAST(src.contactId AS STRING) as contactId
+            FROM `{SOURCE_TABLE}` src
+            WHERE src.startDate >= '{since}'
+            {cutoff_clause}
+            order by src.startDate desc
+            {limit_clause}
+        """
+        print(f"Fetching source records since {since} from BigQuery...")
+        rows = bq_client.query(query).result(page_size=10000)
+        pending = [row.contactId for row in rows if row.contactId not in exclude]
+        return pending[:limit] if limit else pending
+    
+    limit_clause = f"LIMIT {limit}" if limit else ""
+    
+    # Cast contactId to STRING to match tracking table type; NOT EXISTS lets
+    # BigQuery plan an anti-join instead of materializing the LEFT JOIN
     query = f"""
         SELECT CAST(src.contactId AS STRING) as contactId
         FROM `{SOURCE_TABLE}` src
-        LEFT JOIN `{TRACKING_TABLE}` trk
-        ON CAST(src.contactId AS STRING) = trk.contactId
-        WHERE trk.contactId IS NULL
+        WHERE NOT EXISTS (
+            SELECT 1 FROM `{TRACKING_TABLE}` trk
+            WHERE trk.contactId = CAST(src.contactId AS STRING)
+        )
         {cutoff_clause}
         order by src.startDate desc
         {limit_clause}
     """
     print("Fetching pending records from BigQuery...")
-    df = bq_client.query(query).to_dataframe()
-    return df['contactId'].tolist()
+    # A single string column doesn't need a DataFrame; read the rows directly
+    rows = bq_client.query(query).result(page_size=10000)
+    return [row.contactId for row in rows]
+
+def update_checkpoint(bq_client, checkpoint, watermark, pending_ids, written_ids, limit):
+    """
+    Record this run's progress in the local checkpoint.
+
+    The watermark only advances when the run saw every pending contact
+    (fewer than limit) and logged all of them; otherwise the processed IDs
+    are added to the existing checkpoint.
+    """
+    processed_ids = checkpoint["processed_ids"] | written_ids
+    drained = (not limit or len(pending_ids) < limit) and len(written_ids) == len(pending_ids)
+    if drained and watermark is not None and watermark != checkpoint["watermark"]:
+        # The next scan reads startDate >= watermark again, so keep every
+        # processed contact at the new watermark, including those written
+        # by earlier runs that didn't drain; older IDs can be dropped
+        try:
+            processed_ids &= get_contact_ids_since(bq_client, watermark)
+        except Exception as e:
+            print(f"⚠ Could not prune checkpoint, keeping all processed IDs: {e}")
+        new_checkpoint = {"watermark": watermark, "processed_ids": processed_ids}
+    else:
+        new_checkpoint = {
+            "watermark": checkpoint["watermark"],
+            "processed_ids": processed_ids,
+        }
+    save_checkpoint(new_checkpoint)
+    print(f"✓ Checkpoint saved ({len(new_checkpoint['processed_ids'])} processed contacts, "
+          f"watermark {new_checkpoint['watermark']})")
 
 def save_to_bq(bq_client, row_data):
-    """Insert a single result row to BigQuery using DML INSERT."""
+    """
+    Buffer a result row for the tracking table.
+
+    The buffer is written once it holds TRACKING_FLUSH_SIZE rows or
+    TRACKING_FLUSH_SECONDS have passed since the last write.
+    """
+    with _tracking_lock:
+        _tracking_buffer.append(row_data)
+        due = (
+            len(_tracking_buffer) >= TRACKING_FLUSH_SIZE
+            or time.monotonic() - _last_flush >= TRACKING_FLUSH_SECONDS
+        )
+    if due:
+        flush_tracking(bq_client)
+
+def flush_tracking(bq_client):
+    """
+    Write all buffered rows to BigQuery with a single DML INSERT.
+
+    DML (rather than streaming inserts) keeps the rows immediately
+    updatable by the transcription and classification jobs. Rows that hit a
+    transient error go back into the buffer and are retried on the next
+    flush; rows BigQuery rejects are moved to _tracking_rejected.
+    """
+    global _last_flush
+    with _tracking_lock:
+        rows = _tracking_buffer[:]
+        _tracking_buffer.clear()
+        _last_flush = time.monotonic()
+    if not rows:
+        return
+
+    unwritten = insert_tracking_rows(bq_client, rows)
+    if unwritten:
+        with _tracking_lock:
+            _tracking_buffer[:0] = unwritten
+
+def insert_tracking_rows(bq_client, rows):
+    """
+    INSERT rows into the tracking table, isolating rows BigQuery rejects.
+
+    A batch rejected as invalid (400) is split in half and each half retried,
+    so one bad row can't block the rest; a single rejected row is logged and
+    dropped into _tracking_rejected. Returns the rows that failed with any
+    other (presumably transient) error, for the caller to requeue.
+    """
     query = f"""
         INSERT INTO `{TRACKING_TABLE}` (contactId, recording_filename, gcs_uri, fetch_datetime, status, raw_response)
-        VALUES (@contactId, @recording_filename, @gcs_uri, @fetch_datetime, @status, @raw_response)
+        SELECT contactId, recording_filename, gcs_uri, TIMESTAMP(fetch_datetime), status, raw_response
+        FROM UNNEST(@rows)
     """
     job_config = bigquery.QueryJobConfig(
         query_parameters=[
-            bigquery.ScalarQueryParameter("contactId", "STRING", row_data.get("contactId")),
-            bigquery.ScalarQueryParameter("recording_filename", "STRING", row_data.get("recording_filename")),
-            bigquery.ScalarQueryParameter("gcs_uri", "STRING", row_data.get("gcs_uri")),
-            bigquery.ScalarQueryParameter("fetch_datetime", "STRING", row_data.get("fetch_datetime")),
-            bigquery.ScalarQueryParameter("status", "STRING", row_data.get("status")),
-            bigquery.ScalarQueryParameter("raw_response", "STRING", row_data.get("raw_response")),
+            bigquery.ArrayQueryParameter("rows", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("contactId", "STRING", row.get("contactId")),
+                    bigquery.ScalarQueryParameter("recording_filename", "STRING", row.get("recording_filename")),
+                    bigquery.ScalarQueryParameter("gcs_uri", "STRING", row.get("gcs_uri")),
+                    bigquery.ScalarQueryParameter("fetch_datetime", "STRING", row.get("fetch_datetime")),
+                    bigquery.ScalarQueryParameter("status", "STRING", row.get("status")),
+                    bigquery.ScalarQueryParameter("raw_response", "STRING", row.get("raw_response")),
+                )
+                for row in rows
+            ]),
         ]
     )
     try:
         bq_client.query(query, job_config=job_config).result()
-        print(f"  ✓ Logged to BigQuery")
+        print(f"  ✓ Logged {len(rows)} rows to BigQuery")
+        return []
+    except BadRequest as e:
+        if len(rows) == 1:
+            print(f"  ✗ [{rows[0].get('contactId')}] Tracking row rejected by BigQuery, dropping it: {e}")
+            with _tracking_lock:
+                _tracking_rejected.extend(rows)
+            return []
+        print(f"  ⚠ {len(rows)} rows rejected by BigQuery, splitting the batch to isolate the bad row")
+        mid = len(rows) // 2
+        return insert_tracking_rows(bq_client, rows[:mid]) + insert_tracking_rows(bq_client, rows[mid:])
     except Exception as e:
-        print(f"  ✗ Error inserting into BigQuery: {e}")
+        print(f"  ✗ Error inserting {len(rows)} rows into BigQuery: {e}")
+        return rows
 
-def upload_to_gcs(bucket, blob_name, local_file_path):
-    """Upload a file from local path to GCS."""
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(local_file_path)
-    gcs_uri = f"gs://{bucket.name}/{blob_name}"
-    print(f"  ✓ Uploaded to GCS: {gcs_uri}")
-    return gcs_uri
+def build_tracking_row(contact_id, status, raw_response, recording_filename=None, gcs_uri=None):
+    """Build a tracking table row for a processed contact."""
+    return {
+        "contactId": str(contact_id),
+        "recording_filename": recording_filename,
+        "gcs_uri": gcs_uri,
+        "fetch_datetime": datetime.now(timezone.utc).isoformat(),
+        "status": status,
+        "raw_response": raw_response
+    }
 
-def main():
+def transfer_recording(bq_client, bucket, fetcher, contact_id, file_info, raw_response_text):
+    """
+    Stream a recording from CXone straight into GCS and log the result.
+
+    Returns the status written to the tracking table.
+    """
+    file_name = fetcher.recording_filename(file_info["url"], contact_id, file_info["media_type"])
+    gcs_blob_path = f"recordings/{file_name}"
+
+    try:
+        size = fetcher.stream_to_gcs(
+            file_info["url"], bucket.blob(gcs_blob_path), contact_id, file_info["media_type"]
+        )
+        gcs_uri = f"gs://{bucket.name}/{gcs_blob_path}"
+        print(f"  ✓ Streamed to GCS: {gcs_uri} ({size:,} bytes)")
+        row = build_tracking_row(contact_id, "SUCCESS", raw_response_text, file_name, gcs_uri)
+    except Exception as e:
+        print(f"  ✗ Failed to transfer {file_name} for {contact_id}")
+        print(f"  Error: {str(e)}")
+        row = build_tracking_row(contact_id, "FAILED", str(e))
+
+    save_to_bq(bq_client, row)
+    return row["status"]
+
+async def gcs_uploader(bq_client, bucket, fetcher, queue, results):
+    """
+    Consume recordings from the queue and stream them into GCS.
+
+    Runs until it receives None, so transfers overlap with the next
+    metadata fetches.
+    """
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        contact_id, file_info, raw_response_text = item
+        # requests and google-cloud-storage are synchronous, so transfer in a worker thread
+        results[contact_id] = await asyncio.to_thread(
+            transfer_recording, bq_client, bucket, fetcher, contact_id, file_info, raw_response_text
+        )
+
+async def process_contact(session, sem, limiter, queue, auth, fetcher, bq_client, contact_id, index, total, results):
+    """
+    Fetch one contact's recording metadata.
+
+    The recording is handed to the GCS uploaders through the queue;
+    contacts without a recording are logged straight to BigQuery.
+    """
+    contact_id = str(contact_id)
+
+    async with sem:
+        print(f"\n[{index}/{total}] Processing contact: {contact_id}")
+
+        row = None
+        try:
+            # Ensure token is valid (refresh if expired); a refresh is a blocking
+            # HTTP call, so keep it off the event loop
+            await asyncio.to_thread(auth.get_access_token)
+
+            # Fetch recording metadata, backing off when the API throttles us
+            for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+                await limiter.acquire()
+                try:
+                    metadata = await fetcher._get_metadata_async(session, contact_id)
+                    break
+                except RateLimitedException as e:
+                    limiter.on_rate_limited(e.retry_after)
+                    if attempt == MAX_RATE_LIMIT_RETRIES:
+                        raise
+            limiter.on_success()
+
+            # Store raw response as JSON (compact unless DEBUG_JSON is set)
+            raw_response_text = orjson.dumps(metadata, option=RAW_RESPONSE_JSON_OPTION).decode()
+
+            # Extract file URLs
+            file_urls = fetcher.extract_file_urls(metadata)
+
+            if not file_urls:
+                print(f"  ⚠ No recording files found for {contact_id}")
+                row = build_tracking_row(contact_id, "NO_RECORDING", "No recording files found in metadata")
+            else:
+                # Hand the recording (usually first one is voice-only) to the
+                # uploaders; blocks while the queue is full so metadata fetches
+                # can't run far ahead of transfers
+                await queue.put((contact_id, file_urls[0], raw_response_text))
+
+        except RecordingNotFoundException as e:
+            print(f"  ⚠ Recording not found for contact: {contact_id}")
+            row = build_tracking_row(contact_id, "NOT_FOUND", str(e))
+
+        except Exception as e:
+            print(f"  ✗ Failed to process {contact_id}")
+            print(f"  Error: {str(e)}")
+            row = build_tracking_row(contact_id, "FAILED", str(e))
+
+        if row is not None:
+            results[contact_id] = row["status"]
+            # Queue result for BigQuery (may trigger a batch write)
+            await asyncio.to_thread(save_to_bq, bq_client, row)
+
+async def main():
     print("="*70)
     print("CXone Recording Batch Processor")
     print("="*70)
@@ -154,121 +480,70 @@ def main():
     auth = CXoneAuthenticator()
     fetcher = RecordingFetcher(auth)
     
+    # Newest source row before processing starts; becomes the next watermark
+    checkpoint = load_checkpoint()
+    watermark = get_source_watermark(bq_client)
+
     # Get list of pending contacts (use limit for testing)
-    # Remove limit parameter or set to None to process all
-    pending_ids = get_pending_contacts(bq_client, limit=1000)  # Start with 10 for testing
+    # Set limit to None to process all
+    limit = 1000  # Start with 10 for testing
+    pending_ids = get_pending_contacts(
+        bq_client,
+        limit=limit,
+        since=checkpoint["watermark"],
+        exclude=checkpoint["processed_ids"]
+    )
     
     # pending_ids.append(693159199085)
 
     print(f"\n✓ Found {len(pending_ids)} records to process.\n")
 
     if len(pending_ids) == 0:
+        update_checkpoint(bq_client, checkpoint, watermark, pending_ids, set(), limit)
         print("No pending contacts to process. Exiting.")
         return
 
-    processed_count = 0
-    success_count = 0
-    failed_count = 0
+    total = len(pending_ids)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_CONTACTS)
+    limiter = AdaptiveRateLimiter(MAX_REQUESTS_PER_SECOND, MIN_REQUESTS_PER_SECOND)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_CONTACTS)
 
-    for contact_id in pending_ids:
-        processed_count += 1
-        
-        # if processed_count > 4:
-        #     break
+    queue = asyncio.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    results = {}
+    uploaders = [
+        asyncio.create_task(gcs_uploader(bq_client, bucket, fetcher, queue, results))
+        for _ in range(UPLOAD_WORKERS)
+    ]
 
-        print(f"\n{'='*70}")
-        print(f"[{processed_count}/{len(pending_ids)}] Processing contact: {contact_id}")
-        print('='*70)
-        
-        try:
-            # Ensure token is valid (refresh if expired)
-            # The get_access_token() method automatically checks expiry and refreshes
-            auth.get_access_token()
-            
-            # Fetch recording metadata
-            metadata = fetcher.get_recording_metadata(str(contact_id))
-            
-            # Store raw response as JSON
-            raw_response_text = json.dumps(metadata, indent=2)
-            
-            # Extract file URLs
-            file_urls = fetcher.extract_file_urls(metadata)
-            
-            if not file_urls:
-                print(f"  ⚠ No recording files found for {contact_id}")
-                error_row = {
-                    "contactId": str(contact_id),
-                    "recording_filename": None,
-                    "gcs_uri": None,
-                    "fetch_datetime": datetime.now(timezone.utc).isoformat(),
-                    "status": "NO_RECORDING",
-                    "raw_response": "No recording files found in metadata"
-                }
-                save_to_bq(bq_client, error_row)
-                failed_count += 1
-                continue
-            
-            # Download the recording (usually first one is voice-only)
-            file_info = file_urls[0]
-            local_filepath = fetcher.download_recording(
-                file_info["url"],
-                str(contact_id),
-                file_info["media_type"]
-            )
-            
-            # Get just the filename
-            file_name = local_filepath.name
-            
-            # Upload to GCS bucket
-            gcs_blob_path = f"recordings/{file_name}"
-            gcs_uri = upload_to_gcs(bucket, gcs_blob_path, str(local_filepath))
-            
-            # Log Success to BigQuery
-            success_row = {
-                "contactId": str(contact_id),
-                "recording_filename": file_name,
-                "gcs_uri": gcs_uri,
-                "fetch_datetime": datetime.now(timezone.utc).isoformat(),
-                "status": "SUCCESS",
-                "raw_response": raw_response_text
-            }
-            save_to_bq(bq_client, success_row)
-            success_count += 1
-            
-            # Clean up local file to save disk space
-            if local_filepath.exists():
-                local_filepath.unlink()
-                print(f"  ✓ Cleaned up local file")
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*[
+                process_contact(session, sem, limiter, queue, auth, fetcher, bq_client, contact_id, i, total, results)
+                for i, contact_id in enumerate(pending_ids, 1)
+            ])
+    finally:
+        # Let the uploaders drain the queue, then stop them
+        for _ in uploaders:
+            await queue.put(None)
+        await asyncio.gather(*uploaders)
 
-        except RecordingNotFoundException as e:
-            print(f"  ⚠ Recording not found for contact: {contact_id}")
-            error_row = {
-                "contactId": str(contact_id),
-                "recording_filename": None,
-                "gcs_uri": None,
-                "fetch_datetime": datetime.now(timezone.utc).isoformat(),
-                "status": "NOT_FOUND",
-                "raw_response": str(e)
-            }
-            save_to_bq(bq_client, error_row)
-            failed_count += 1
+        # Write whatever is still buffered, even if the run was interrupted
+        flush_tracking(bq_client)
+        if _tracking_buffer:
+            print(f"  ✗ {len(_tracking_buffer)} tracking rows could not be written to BigQuery")
+        if _tracking_rejected:
+            print(f"  ✗ {len(_tracking_rejected)} tracking rows were rejected by BigQuery")
 
-        except Exception as e:
-            print(f"  ✗ Failed to process {contact_id}")
-            print(f"  Error: {str(e)}")
-            error_row = {
-                "contactId": str(contact_id),
-                "recording_filename": None,
-                "gcs_uri": None,
-                "fetch_datetime": datetime.now(timezone.utc).isoformat(),
-                "status": "FAILED",
-                "raw_response": str(e)
-            }
-            save_to_bq(bq_client, error_row)
-            failed_count += 1
-
-        # Rate limiting sleep
-        time.sleep(SLEEP_TIME)
+        # Only contacts whose tracking rows reached BigQuery count as processed
+        unwritten_ids = {row["contactId"] for row in _tracking_buffer + _tracking_rejected}
+        update_checkpoint(bq_client, checkpoint, watermark, pending_ids, set(results) - unwritten_ids, limit)
+        fetcher.close()
+        auth.close()
+
+    statuses = list(results.values())
+    processed_count = len(statuses)
+    success_count = statuses.count("SUCCESS")
+    failed_count = processed_count - success_count
     
     # Final Summary
     print("\n" + "="*70)
@@ -280,4 +555,4 @@ def main():
     print("="*70)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
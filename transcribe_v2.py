@@ -8,24 +8,31 @@ topic detection, intent recognition, sentiment analysis), and saves results
 back to BigQuery.
 """
 
-import os
 import sys
 import time
 import json
-import requests
+import random
+import asyncio
+import threading
+import aiohttp
+import orjson
+import numpy as np
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from google.cloud import bigquery, storage
-from dotenv import load_dotenv
+import config
 
-# Load environment variables
-load_dotenv()
+# google.cloud.bigquery/storage and google.auth are imported inside the
+# functions that use them: they are slow to import, and this keeps startup
+# (and the missing-config error below) fast.
 
 # --- CONFIGURATION ---
-PROJECT_ID = os.getenv("GCP_PROJECT_ID")
-DATASET_ID = os.getenv("GCP_DATASET_ID")
-TRACKING_TABLE_NAME = os.getenv("GCP_TRACKING_TABLE")
-BUCKET_NAME = os.getenv("GCS_BUCKET_NAME")
-DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
+PROJECT_ID = config.get("GCP_PROJECT_ID")
+DATASET_ID = config.get("GCP_DATASET_ID")
+TRACKING_TABLE_NAME = config.get("GCP_TRACKING_TABLE")
+BUCKET_NAME = config.get("GCS_BUCKET_NAME")
+DEEPGRAM_API_KEY = config.get("DEEPGRAM_API_KEY")
 
 # Validate required environment variables
 required_vars = {
@@ -49,22 +56,247 @@ TRACKING_TABLE = f"{PROJECT_ID}.{DATASET_ID}.{TRACKING_TABLE_NAME}"
 DEEPGRAM_API_URL = "https://api.deepgram.com/v1/listen"
 DEEPGRAM_MODEL = "nova-3"
 
-# Rate limiting
-SLEEP_BETWEEN_CALLS = 1.0  # seconds between Deepgram API calls
+# Concurrency: Deepgram calls in flight at once (well under Deepgram's
+# concurrent pre-recorded request limit)
+MAX_CONCURRENT_CALLS = 50
+
+# Deepgram rate limiting: token bucket on request starts, plus backoff on 429
+DEEPGRAM_REQUESTS_PER_MINUTE = 300
+DEEPGRAM_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 1.0  # doubled on each retry, plus up to this much jitter
+BACKOFF_MAX_SECONDS = 30.0
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Circuit breaker: after this many consecutive 5xx/connection failures, fail
+# Deepgram calls immediately for BREAKER_RESET_SECONDS, then try one call
+BREAKER_FAIL_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 60
+
+# HTTP connection pool for Deepgram: keep TLS connections and DNS lookups
+# warm across calls instead of the aiohttp defaults (15s keep-alive, 10s DNS)
+HTTP_POOL_SIZE = 64
+HTTP_KEEPALIVE_SECONDS = 60
+DNS_CACHE_SECONDS = 300
+
+# BigQuery result writes: rows are streamed (insertAll, not DML) into a
+# results table and applied to the tracking table with one MERGE per run
+RESULTS_TABLE_NAME = "transcription_results"
+RESULTS_TABLE = f"{PROJECT_ID}.{DATASET_ID}.{RESULTS_TABLE_NAME}"
+WRITE_BATCH_SIZE = 500  # rows per insert_rows_json call
+WRITE_MAX_REQUEST_BYTES = 8 * 1024 * 1024  # insertAll requests are capped at 10 MB
+WRITE_FLUSH_SECONDS = 5.0  # flush a partial batch after this long
+RESULTS_LOOKBACK_DAYS = 7  # how far back startup looks for results never merged
+
+# Result columns stored as strings (besides success and written_at)
+RESULT_STRING_FIELDS = (
+    "contactId", "transcription", "transcription_raw", "summary",
+    "topics", "intents", "sentiment", "error_msg",
+)
+
+# Result columns parse_deepgram_response returns as Python objects; they are
+# stored as JSON strings, serialized in the writer thread
+JSON_RESULT_FIELDS = ("topics", "intents", "sentiment")
+
+# Applies results written since @since (only successes when @successes_only)
+# to tracking rows that are still untranscribed. A contact can have several recordings, so keep one result
+# per contactId (preferring a success, then the newest) for MERGE to match.
+MERGE_RESULTS_QUERY = f"""
+    MERGE `{TRACKING_TABLE}` T
+    USING (
+        SELECT *
+        FROM `{RESULTS_TABLE}`
+        WHERE written_at >= @since
+          AND (success OR NOT @successes_only)
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY contactId ORDER BY success DESC, written_at DESC) = 1
+    ) S
+    ON T.contactId = S.contactId
+    WHEN MATCHED AND (T.transcribed IS NULL OR T.transcribed = 0) AND S.success THEN UPDATE SET
+        transcribed = 1,
+        analysed = 1,
+        transcription = S.transcription,
+        transcription_raw = S.transcription_raw,
+        summary = S.summary,
+        topics = S.topics,
+        intents = S.intents,
+        sentiment = S.sentiment
+    WHEN MATCHED AND (T.transcribed IS NULL OR T.transcribed = 0) THEN UPDATE SET
+        -- On failure, mark as attempted but not successful
+        transcribed = 0,
+        analysed = 0,
+        transcription = S.error_msg
+"""
+
+# Pending rows are streamed from BigQuery in pages into a bounded queue
+PENDING_PAGE_SIZE = 1000
+RECORD_QUEUE_SIZE = 100
+
+# Signer stage: URLs are signed ahead of the Deepgram workers, a few at a
+# time so most are used fresh (stale ones are re-signed, see SignedAudioUrl)
+SIGNER_TASKS = 4
+SIGNED_QUEUE_SIZE = 8
+
+# Threads for blocking client calls (signed URLs, BigQuery pages and writes):
+# one per signer plus the producer and the result writer
+BLOCKING_IO_THREADS = SIGNER_TASKS + 2
+
+# Records that ensure_new_columns already patched this table, so later runs
+# skip the schema fetch. Delete the file to force a re-check.
+SCHEMA_SENTINEL_FILE = Path(".schema_v2_done")
+SCHEMA_CHECK_TIMEOUT_SECONDS = 5
 
-# Signed URL expiry
+# Signed URL expiry. A URL older than SIGNED_URL_REFRESH_MINUTES is signed
+# again before it is sent, leaving Deepgram at least 5 minutes to fetch it
 SIGNED_URL_EXPIRY_MINUTES = 15
+SIGNED_URL_REFRESH_MINUTES = 10
+
+# Shared read-only defaults for missing fields in Deepgram responses
+_EMPTY_DICT = MappingProxyType({})
+_EMPTY_LIST = ()
+
+
+def _parse_retry_after(value):
+    """Parse a Retry-After header given in seconds; HTTP-dates are ignored."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Deepgram while the circuit breaker is open."""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stop calling Deepgram during an outage instead of waiting on every call.
+
+    After fail_threshold consecutive failures (5xx, timeouts, connection
+    errors) the breaker opens and calls fail immediately with
+    CircuitOpenError. After reset_timeout seconds one trial call is let
+    through: success closes the breaker, failure re-opens it, and a trial
+    that ends any other way must call release_trial(). Shared by tasks on
+    one event loop, so no lock is needed.
+    """
+
+    def __init__(self, fail_threshold, reset_timeout):
+        self._fail_threshold = fail_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError unless a call may go ahead.
+
+        Returns True when the call is the half-open trial.
+        """
+        if self._opened_at is None:
+            return False
+        if self._trial_in_flight or time.monotonic() - self._opened_at < self._reset_timeout:
+            raise CircuitOpenError("Deepgram circuit breaker is open; call skipped")
+        # Half-open: let this one call through as a trial
+        self._trial_in_flight = True
+        return True
+
+    def release_trial(self):
+        """Free the trial slot after a trial that recorded no outcome (e.g. cancelled)."""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        """Close the breaker after a call Deepgram answered normally."""
+        if self._opened_at is not None:
+            print("  ✓ Deepgram is responding again; circuit breaker closed")
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        """Count a failed call, opening the breaker at the threshold."""
+        self._failures += 1
+        if self._trial_in_flight or (self._opened_at is None and self._failures >= self._fail_threshold):
+            print(f"  ⚠ Deepgram failing ({self._failures} consecutive errors); pausing calls for {self._reset_timeout}s")
+            self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+
+_deepgram_breaker = CircuitBreaker(BREAKER_FAIL_THRESHOLD, BREAKER_RESET_SECONDS)
+
+
+class DeepgramRateLimiter:
+    """
+    Adaptive limiter for Deepgram calls: a cap on calls in flight plus a
+    requests-per-minute token bucket.
+
+    A 429, or an X-RateLimit-Remaining header of 0, halves the number of
+    calls allowed in flight; every other response raises it by one, up to
+    max_concurrency. Shared by tasks on one event loop.
+    """
+
+    def __init__(self, max_concurrency, requests_per_minute):
+        self._max_concurrency = max_concurrency
+        self._concurrency = max_concurrency
+        self._in_flight = 0
+        self._slots = asyncio.Condition()
+        self._rate = requests_per_minute / 60.0
+        self._capacity = float(max_concurrency)  # burst size
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+
+    async def _take_token(self):
+        """Reserve a token, sleeping until it has been refilled if needed."""
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+    async def __aenter__(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._in_flight < self._concurrency)
+            self._in_flight += 1
+        try:
+            await self._take_token()
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._slots:
+            self._in_flight -= 1
+            self._slots.notify_all()
+
+    def on_response(self, status, headers):
+        """Shrink or grow the concurrency cap from a Deepgram response."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        if status == 429 or remaining == "0":
+            self._concurrency = max(1, self._concurrency // 2)
+            print(f"  ⏳ Rate limited by Deepgram; allowing {self._concurrency} call(s) in flight")
+        elif self._concurrency < self._max_concurrency:
+            self._concurrency += 1
 
 
 def init_clients():
     """Initialize BigQuery and GCS clients."""
+    from google.cloud import bigquery, storage
+
     bq_client = bigquery.Client(project=PROJECT_ID)
     gcs_client = storage.Client(project=PROJECT_ID)
     return bq_client, gcs_client
 
 
 def ensure_new_columns(bq_client):
-    """Add new columns to the tracking table if they don't exist."""
+    """
+    Add new columns to the tracking table if they don't exist.
+
+    Skipped when SCHEMA_SENTINEL_FILE records that this table already has
+    the current set of columns.
+    """
+    from google.cloud import bigquery
+
     new_columns = [
         bigquery.SchemaField("transcribed", "INTEGER", mode="NULLABLE"),
         bigquery.SchemaField("analysed", "INTEGER", mode="NULLABLE"),
@@ -77,7 +309,18 @@ def ensure_new_columns(bq_client):
         bigquery.SchemaField("gemini_analysed", "INTEGER", mode="NULLABLE"),
     ]
 
-    table = bq_client.get_table(TRACKING_TABLE)
+    schema_version = f"{TRACKING_TABLE}:{','.join(col.name for col in new_columns)}"
+    try:
+        if SCHEMA_SENTINEL_FILE.read_text() == schema_version:
+            print("✓ All required columns already exist.")
+            return
+    except OSError:
+        pass
+
+    table = bq_client.get_table(
+        TRACKING_TABLE,
+        retry=bigquery.DEFAULT_RETRY.with_deadline(SCHEMA_CHECK_TIMEOUT_SECONDS),
+    )
     existing_field_names = {field.name for field in table.schema}
 
     columns_to_add = [col for col in new_columns if col.name not in existing_field_names]
@@ -91,11 +334,14 @@ def ensure_new_columns(bq_client):
     else:
         print("✓ All required columns already exist.")
 
+    SCHEMA_SENTINEL_FILE.write_text(schema_version)
+
 
 def get_pending_transcriptions(bq_client, limit=None):
     """
     Fetch records that have a GCS URI but haven't been transcribed yet.
-    Returns list of dicts with contactId and gcs_uri.
+    Returns the query's RowIterator (rows with contactId and gcs_uri), which
+    downloads results a page at a time as it is consumed.
     """
     limit_clause = f"LIMIT {limit}" if limit else ""
 
@@ -110,9 +356,37 @@ def get_pending_transcriptions(bq_client, limit=None):
     """
 
     print("Fetching pending transcriptions from BigQuery...")
-    rows = bq_client.query(query).result()
-    results = [{"contactId": row.contactId, "gcs_uri": row.gcs_uri} for row in rows]
-    return results
+    return bq_client.query(query).result(page_size=PENDING_PAGE_SIZE)
+
+
+_signing_lock = threading.Lock()
+
+
+def get_signing_kwargs(gcs_client):
+    """
+    Extra generate_signed_url arguments for credentials that can't sign locally.
+
+    A service account key already signs V4 URLs locally, so nothing is
+    needed. Credentials without a private key (e.g. the Cloud Run / GCE
+    metadata server) sign through IAM signBlob using the account email and
+    an access token; the token is refreshed only when it has expired, not
+    fetched again for every URL.
+    """
+    from google.auth.credentials import Signing
+    from google.auth.transport.requests import Request
+
+    credentials = gcs_client._credentials
+    if isinstance(credentials, Signing):
+        return _EMPTY_DICT
+
+    # Signer threads share the credentials; refresh them one at a time
+    with _signing_lock:
+        if not credentials.valid:
+            credentials.refresh(Request())
+        return {
+            "service_account_email": credentials.service_account_email,
+            "access_token": credentials.token,
+        }
 
 
 def generate_signed_url(gcs_client, gcs_uri):
@@ -128,9 +402,7 @@ def generate_signed_url(gcs_client, gcs_uri):
     """
     # Parse gs:// URI
     # gs://bucket-name/path/to/file -> bucket-name, path/to/file
-    path = gcs_uri.replace("gs://", "")
-    bucket_name = path.split("/")[0]
-    blob_path = "/".join(path.split("/")[1:])
+    bucket_name, _, blob_path = gcs_uri.removeprefix("gs://").partition("/")
 
     bucket = gcs_client.bucket(bucket_name)
     blob = bucket.blob(blob_path)
@@ -139,12 +411,36 @@ def generate_signed_url(gcs_client, gcs_uri):
         version="v4",
         expiration=timedelta(minutes=SIGNED_URL_EXPIRY_MINUTES),
         method="GET",
+        **get_signing_kwargs(gcs_client),
     )
 
     return signed_url
 
 
-def call_deepgram_api(audio_url):
+class SignedAudioUrl:
+    """
+    A signed URL for one recording that is re-signed when it gets stale.
+
+    The signer stage signs ahead of the Deepgram workers, but a record can
+    then wait on the rate limiter and retry for longer than the URL lives,
+    so call_deepgram_api asks for the URL at the start of every attempt.
+    """
+
+    def __init__(self, gcs_client, gcs_uri, url):
+        self._gcs_client = gcs_client
+        self._gcs_uri = gcs_uri
+        self._url = url
+        self._signed_at = time.monotonic()
+
+    async def get(self):
+        """Return the URL, signing a new one (in a thread) if it is stale."""
+        if time.monotonic() - self._signed_at >= SIGNED_URL_REFRESH_MINUTES * 60:
+            self._url = await asyncio.to_thread(generate_signed_url, self._gcs_client, self._gcs_uri)
+            self._signed_at = time.monotonic()
+        return self._url
+
+
+async def call_deepgram_api(session, limiter, audio_url):
     """
     Call Deepgram API with transcription + all audio intelligence features.
     
@@ -158,14 +454,24 @@ def call_deepgram_api(audio_url):
     - Intent Recognition
     - Sentiment Analysis
     
+    A 429, 5xx, timeout or connection/payload error is retried up to
+    DEEPGRAM_MAX_ATTEMPTS times, waiting for the Retry-After header or an
+    exponential backoff with jitter. Failures feed the circuit breaker,
+    which fails calls fast while Deepgram is down.
+    
+    Args:
+        session: aiohttp.ClientSession shared by all concurrent calls
+        limiter: DeepgramRateLimiter shared by all concurrent calls
+        audio_url: SignedAudioUrl Deepgram downloads the recording from;
+            it is re-checked for staleness after each limiter wait
+    
     Returns:
         dict: Full API response
+    
+    Raises:
+        aiohttp.ClientResponseError: If Deepgram returns an error status
+        CircuitOpenError: If the circuit breaker is open
     """
-    headers = {
-        "Authorization": f"Token {DEEPGRAM_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
     params = {
         "model": DEEPGRAM_MODEL,
         "smart_format": "true",
@@ -177,19 +483,50 @@ def call_deepgram_api(audio_url):
         "intents": "true",
         "sentiment": "true",
     }
+    # Deepgram always returns word-level timings (there is no option to
+    # leave them out), and format_multichannel_conversation needs them for
+    # stereo calls anyway; mono calls only read the utterance transcripts.
 
-    payload = {"url": audio_url}
-
-    response = requests.post(
-        DEEPGRAM_API_URL,
-        headers=headers,
-        params=params,
-        json=payload,
-        timeout=300,  # 5 minute timeout for large files
-    )
-
-    response.raise_for_status()
-    return response.json()
+    last_attempt = DEEPGRAM_MAX_ATTEMPTS - 1
+    for attempt in range(DEEPGRAM_MAX_ATTEMPTS):
+        trial = _deepgram_breaker.before_call()
+        try:
+            async with limiter:
+                payload = {"url": await audio_url.get()}
+                async with session.post(
+                    DEEPGRAM_API_URL,
+                    params=params,
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=300),  # 5 minute timeout for large files
+                ) as response:
+                    limiter.on_response(response.status, response.headers)
+                    if response.status >= 500:
+                        _deepgram_breaker.record_failure()
+                    else:
+                        _deepgram_breaker.record_success()
+                    if response.status not in RETRY_STATUSES or attempt == last_attempt:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+                    reason = f"returned {response.status}"
+                    delay = _parse_retry_after(response.headers.get("Retry-After"))
+        except aiohttp.ClientResponseError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            _deepgram_breaker.record_failure()
+            if attempt == last_attempt:
+                raise
+            reason = f"request failed ({type(e).__name__})"
+            delay = None
+        finally:
+            # A trial that was cancelled or raised something the breaker
+            # doesn't count must not leave it stuck half-open
+            if trial:
+                _deepgram_breaker.release_trial()
+
+        if delay is None:
+            delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt) + random.uniform(0, BACKOFF_BASE_SECONDS)
+        print(f"  ⏳ Deepgram {reason}; retrying in {delay:.1f}s (attempt {attempt + 2}/{DEEPGRAM_MAX_ATTEMPTS})")
+        await asyncio.sleep(delay)
 
 
 def format_conversation(utterances):
@@ -212,13 +549,13 @@ def format_conversation(utterances):
         str: Formatted conversation string
     """
     lines = []
+    append = lines.append
     for utt in utterances:
         # Deepgram uses 0-indexed speaker IDs, we display as 1-indexed
-        speaker_id = utt.get("speaker", 0)
-        speaker_name = f"Speaker {speaker_id + 1}"
-        transcript = utt.get("transcript", "").strip()
+        speaker_id = utt["speaker"] if "speaker" in utt else 0
+        transcript = (utt["transcript"] if "transcript" in utt else "").strip()
         if transcript:
-            lines.append(f"{speaker_name}: {transcript}")
+            append(f"Speaker {speaker_id + 1}: {transcript}")
     return "\n".join(lines)
 
 
@@ -238,61 +575,61 @@ def format_multichannel_conversation(channels):
     """
     CHANNEL_LABELS = {0: "Agent", 1: "Customer"}
     
-    # Collect all words from all channels with their channel info
-    all_words = []
+    # Collect all words as parallel arrays: text, start time, channel
+    words = []
+    starts = []
+    channel_ids = []
     for ch_idx, channel in enumerate(channels):
-        alternatives = channel.get("alternatives", [])
+        alternatives = channel.get("alternatives", _EMPTY_LIST)
         if not alternatives:
             continue
-        for word_info in alternatives[0].get("words", []):
-            all_words.append({
-                "word": word_info.get("word", ""),
-                "start": word_info.get("start", 0),
-                "end": word_info.get("end", 0),
-                "channel": ch_idx,
-            })
-    
-    # Sort all words by start time
-    all_words.sort(key=lambda w: w["start"])
+        channel_words = alternatives[0].get("words", _EMPTY_LIST)
+        words.extend(w["word"] if "word" in w else "" for w in channel_words)
+        starts.extend(w["start"] if "start" in w else 0 for w in channel_words)
+        channel_ids.extend([ch_idx] * len(channel_words))
     
-    # Group consecutive words by the same channel into utterances
-    if not all_words:
+    if not words:
         return ""
     
-    utterances = []
-    current_channel = all_words[0]["channel"]
-    current_words = [all_words[0]["word"]]
+    # Sort all words by start time (stable, so ties keep channel order)
+    order = np.argsort(np.asarray(starts, dtype=np.float64), kind="stable")
+    ordered_channels = np.asarray(channel_ids, dtype=np.int16)[order]
+    ordered_words = [words[i] for i in order.tolist()]
     
-    for word in all_words[1:]:
-        if word["channel"] == current_channel:
-            current_words.append(word["word"])
-        else:
-            # Speaker changed — save current utterance
-            utterances.append({
-                "channel": current_channel,
-                "text": " ".join(current_words),
-            })
-            current_channel = word["channel"]
-            current_words = [word["word"]]
-    
-    # Don't forget the last utterance
-    if current_words:
-        utterances.append({
-            "channel": current_channel,
-            "text": " ".join(current_words),
-        })
+    # Group consecutive words by the same channel into utterances: a new
+    # utterance starts wherever the channel changes
+    bounds = [0, *(np.flatnonzero(np.diff(ordered_channels)) + 1).tolist(), len(ordered_words)]
     
     # Format as conversation
     lines = []
-    for utt in utterances:
-        label = CHANNEL_LABELS.get(utt["channel"], f"Channel {utt['channel'] + 1}")
-        text = utt["text"].strip()
+    append = lines.append
+    for begin, end in zip(bounds, bounds[1:]):
+        channel = int(ordered_channels[begin])
+        label = CHANNEL_LABELS.get(channel, f"Channel {channel + 1}")
+        text = " ".join(ordered_words[begin:end]).strip()
         if text:
-            lines.append(f"{label}: {text}")
+            append(f"{label}: {text}")
     
     return "\n".join(lines)
 
 
+def _flatten_segments(segments, items_key, label_key):
+    """
+    Flatten Deepgram topic/intent segments into one list of
+    {label_key, confidence, text} dicts, one per detected item.
+    """
+    return [
+        {
+            label_key: item.get(label_key, ""),
+            "confidence": item.get("confidence_score", 0),
+            "text": text,
+        }
+        for seg in segments
+        for text in (seg.get("text", ""),)
+        for item in seg.get(items_key, _EMPTY_LIST)
+    ]
+
+
 def parse_deepgram_response(response):
     """
     Parse the Deepgram API response to extract transcription and analysis.
@@ -301,6 +638,9 @@ def parse_deepgram_response(response):
     - Multichannel (stereo): Agent/Customer labels from channels
     - Mono with diarization: Speaker 1/2/3 labels from utterances
     
+    Topics, intents and sentiment are returned as Python lists/dicts; the
+    BigQuery writer serializes them to JSON (see JSON_RESULT_FIELDS).
+    
     Returns:
         dict with keys: transcription, summary, topics, intents, sentiment
     """
@@ -308,18 +648,19 @@ def parse_deepgram_response(response):
         "transcription": "",
         "transcription_raw": "",
         "summary": "",
-        "topics": "[]",
-        "intents": "[]",
-        "sentiment": "{}",
+        "topics": [],
+        "intents": [],
+        "sentiment": {},
     }
 
     try:
-        channels = response.get("results", {}).get("channels", [])
+        results = response.get("results") or _EMPTY_DICT
+        channels = results.get("channels", _EMPTY_LIST)
         num_channels = len(channels)
         
         # Extract raw transcript (plain text without speaker labels)
         if channels:
-            alternatives = channels[0].get("alternatives", [])
+            alternatives = channels[0].get("alternatives", _EMPTY_LIST)
             if alternatives:
                 result["transcription_raw"] = alternatives[0].get("transcript", "")
         
@@ -330,10 +671,10 @@ def parse_deepgram_response(response):
             result["transcription"] = format_multichannel_conversation(channels)
         else:
             # MONO: use diarization-based utterances
-            utterances = response.get("results", {}).get("utterances", [])
+            utterances = results.get("utterances", _EMPTY_LIST)
             if utterances:
                 # Count unique speakers
-                speakers = set(u.get("speaker", 0) for u in utterances)
+                speakers = {u["speaker"] if "speaker" in u else 0 for u in utterances}
                 print(f"  🎙️ Detected {len(speakers)} speaker(s) in mono audio — using Speaker labels")
                 result["transcription"] = format_conversation(utterances)
             else:
@@ -341,58 +682,40 @@ def parse_deepgram_response(response):
                 result["transcription"] = result["transcription_raw"]
 
         # Extract summary
-        summary_data = response.get("results", {}).get("summary", {})
+        summary_data = results.get("summary", _EMPTY_DICT)
         if summary_data:
             result["summary"] = summary_data.get("short", "")
 
         # Extract topics
-        topics_data = response.get("results", {}).get("topics", {})
+        topics_data = results.get("topics", _EMPTY_DICT)
         if topics_data:
-            segments = topics_data.get("segments", [])
-            all_topics = []
-            for seg in segments:
-                for topic_item in seg.get("topics", []):
-                    all_topics.append({
-                        "topic": topic_item.get("topic", ""),
-                        "confidence": topic_item.get("confidence_score", 0),
-                        "text": seg.get("text", ""),
-                    })
-            result["topics"] = json.dumps(all_topics)
+            result["topics"] = _flatten_segments(topics_data.get("segments", _EMPTY_LIST), "topics", "topic")
 
         # Extract intents
-        intents_data = response.get("results", {}).get("intents", {})
+        intents_data = results.get("intents", _EMPTY_DICT)
         if intents_data:
-            segments = intents_data.get("segments", [])
-            all_intents = []
-            for seg in segments:
-                for intent_item in seg.get("intents", []):
-                    all_intents.append({
-                        "intent": intent_item.get("intent", ""),
-                        "confidence": intent_item.get("confidence_score", 0),
-                        "text": seg.get("text", ""),
-                    })
-            result["intents"] = json.dumps(all_intents)
+            result["intents"] = _flatten_segments(intents_data.get("segments", _EMPTY_LIST), "intents", "intent")
 
         # Extract sentiment
-        sentiments_data = response.get("results", {}).get("sentiments", {})
+        sentiments_data = results.get("sentiments", _EMPTY_DICT)
         if sentiments_data:
-            segments = sentiments_data.get("segments", [])
-            average = sentiments_data.get("average", {})
+            segments = sentiments_data.get("segments", _EMPTY_LIST)
+            average = sentiments_data.get("average", _EMPTY_DICT)
 
-            sentiment_result = {
+            result["sentiment"] = {
                 "average": {
                     "sentiment": average.get("sentiment", "neutral"),
                     "sentiment_score": average.get("sentiment_score", 0),
                 },
-                "segments": [],
+                "segments": [
+                    {
+                        "text": seg.get("text", ""),
+                        "sentiment": seg.get("sentiment", "neutral"),
+                        "sentiment_score": seg.get("sentiment_score", 0),
+                    }
+                    for seg in segments
+                ],
             }
-            for seg in segments:
-                sentiment_result["segments"].append({
-                    "text": seg.get("text", ""),
-                    "sentiment": seg.get("sentiment", "neutral"),
-                    "sentiment_score": seg.get("sentiment_score", 0),
-                })
-            result["sentiment"] = json.dumps(sentiment_result)
 
     except Exception as e:
         print(f"  ⚠ Warning parsing response: {e}")
@@ -400,141 +723,300 @@ def parse_deepgram_response(response):
     return result
 
 
-def update_bigquery_row(bq_client, contact_id, parsed_data, success=True):
-    """
-    Update the BigQuery row with transcription and analysis results.
-    Uses DML UPDATE statement.
-    """
-    if success:
-        query = f"""
-            UPDATE `{TRACKING_TABLE}`
-            SET
-                transcribed = 1,
-                analysed = 1,
-                transcription = @transcription,
-                transcription_raw = @transcription_raw,
-                summary = @summary,
-                topics = @topics,
-                intents = @intents,
-                sentiment = @sentiment
-            WHERE contactId = @contact_id
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("transcription", "STRING", parsed_data["transcription"]),
-                bigquery.ScalarQueryParameter("transcription_raw", "STRING", parsed_data["transcription_raw"]),
-                bigquery.ScalarQueryParameter("summary", "STRING", parsed_data["summary"]),
-                bigquery.ScalarQueryParameter("topics", "STRING", parsed_data["topics"]),
-                bigquery.ScalarQueryParameter("intents", "STRING", parsed_data["intents"]),
-                bigquery.ScalarQueryParameter("sentiment", "STRING", parsed_data["sentiment"]),
-                bigquery.ScalarQueryParameter("contact_id", "STRING", contact_id),
-            ]
-        )
-    else:
-        # On failure, mark as attempted but not successful
-        query = f"""
-            UPDATE `{TRACKING_TABLE}`
-            SET
-                transcribed = 0,
-                analysed = 0,
-                transcription = @error_msg
-            WHERE contactId = @contact_id
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("error_msg", "STRING", parsed_data.get("error", "Unknown error")),
-                bigquery.ScalarQueryParameter("contact_id", "STRING", contact_id),
-            ]
-        )
+def ensure_results_table(bq_client):
+    """Create the transcription results table if it doesn't exist."""
+    from google.cloud import bigquery
 
-    bq_client.query(query, job_config=job_config).result()
-    print(f"  ✓ BigQuery updated (transcribed={'1' if success else '0'})")
+    table = bigquery.Table(
+        RESULTS_TABLE,
+        schema=[bigquery.SchemaField(name, "STRING") for name in RESULT_STRING_FIELDS]
+        + [
+            bigquery.SchemaField("success", "BOOLEAN"),
+            bigquery.SchemaField("written_at", "TIMESTAMP"),
+        ],
+    )
+    table.time_partitioning = bigquery.TimePartitioning(field="written_at")
+    bq_client.create_table(table, exists_ok=True)
 
 
-def main():
-    print("=" * 70)
-    print("CXone Transcription & Analysis Pipeline (Deepgram)")
+def save_results(bq_client, rows):
+    """
+    Stream result rows into the results table with insert_rows_json.
+
+    JSON_RESULT_FIELDS are serialized here rather than in the Deepgram
+    workers. Rows are sent WRITE_BATCH_SIZE at a time, split further so each
+    request stays under WRITE_MAX_REQUEST_BYTES.
+    """
+    written_at = datetime.now(timezone.utc).isoformat()
+    chunk, chunk_bytes = [], 0
+    chunks = []
+    for row, success in rows:
+        row = {**row, "success": success, "written_at": written_at}
+        for name in JSON_RESULT_FIELDS:
+            if name in row:
+                row[name] = orjson.dumps(row[name]).decode()
+        # Measure the row as the client will send it: the insertAll body is
+        # json.dumps'd with ensure_ascii, so non-ASCII characters and escaped
+        # quotes/newlines take several bytes each
+        size = len(json.dumps(row))
+        if chunk and (len(chunk) >= WRITE_BATCH_SIZE or chunk_bytes + size > WRITE_MAX_REQUEST_BYTES):
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(row)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+
+    for chunk in chunks:
+        errors = bq_client.insert_rows_json(RESULTS_TABLE, chunk)
+        if errors:
+            print(f"  ✗ BigQuery rejected {len(errors)} of {len(chunk)} result row(s): {errors[:3]}")
+        else:
+            print(f"  ✓ Saved {len(chunk)} result(s) to BigQuery")
+
+
+def merge_results(bq_client, since, successes_only=False):
+    """
+    Apply results written since the given time to the tracking table in a
+    single MERGE. Returns the number of tracking rows updated.
+    """
+    from google.cloud import bigquery
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("since", "TIMESTAMP", since),
+            bigquery.ScalarQueryParameter("successes_only", "BOOL", successes_only),
+        ]
+    )
+    job = bq_client.query(MERGE_RESULTS_QUERY, job_config=job_config)
+    job.result()
+    return job.num_dml_affected_rows or 0
+
+
+async def results_writer(bq_client, queue):
+    """
+    Consume (row, success) pairs from the queue and stream them to the
+    results table in batches of WRITE_BATCH_SIZE, or whatever arrived within
+    WRITE_FLUSH_SECONDS. Stops after a None sentinel.
+    """
+    loop = asyncio.get_running_loop()
+    finished = False
+
+    while not finished:
+        batch = []
+        deadline = loop.time() + WRITE_FLUSH_SECONDS
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                finished = True
+                break
+            batch.append(item)
+
+        if not batch:
+            continue
+        try:
+            await asyncio.to_thread(save_results, bq_client, batch)
+        except Exception as e:
+            print(f"  ✗ Failed to save {len(batch)} result(s): {e}")
+
+
+async def process_record(session, limiter, results_queue, record, audio_url, index, total):
+    """
+    Transcribe and analyse a single (already signed) recording, then queue
+    the result for the BigQuery writer. Returns True on success, False on
+    failure.
+    """
+    contact_id = record["contactId"]
+    gcs_uri = record["gcs_uri"]
+
+    print(f"\n{'=' * 70}")
+    print(f"[{index}/{total}] Contact: {contact_id}")
+    print(f"  GCS: {gcs_uri}")
     print("=" * 70)
-    print(f"Model: {DEEPGRAM_MODEL}")
-    print(f"Table: {TRACKING_TABLE}")
-    print()
 
-    # Initialize clients
-    bq_client, gcs_client = init_clients()
+    try:
+        # Step 1: Call Deepgram API (the signer stage already signed the URL)
+        print(f"  ⏳ [{contact_id}] Calling Deepgram API (transcription + analysis)...")
+        api_response = await call_deepgram_api(session, limiter, audio_url)
+        print(f"  ✓ [{contact_id}] Deepgram API response received")
 
-    # Ensure new columns exist
-    ensure_new_columns(bq_client)
+        # Step 2: Parse response
+        parsed = parse_deepgram_response(api_response)
 
-    # Get pending transcriptions
-    # Set limit for testing, remove or set to None for full processing
-    pending = get_pending_transcriptions(bq_client, limit=10)
+        # Show preview
+        transcript_preview = parsed["transcription"][:100]
+        print(f"  📝 [{contact_id}] Transcript: {transcript_preview}{'...' if len(parsed['transcription']) > 100 else ''}")
+        print(f"  📋 [{contact_id}] Summary: {parsed['summary'][:100]}{'...' if len(parsed['summary']) > 100 else ''}")
 
-    print(f"\n✓ Found {len(pending)} recordings to transcribe.\n")
+        # Step 3: Hand off to the batched BigQuery writer
+        await results_queue.put(({"contactId": contact_id, **parsed}, True))
 
-    if not pending:
-        print("No pending transcriptions. Exiting.")
-        return
+        print(f"  ✅ [{contact_id}] Done!")
+        return True
 
-    processed = 0
-    success_count = 0
-    failed_count = 0
+    except aiohttp.ClientResponseError as e:
+        print(f"  ✗ [{contact_id}] Deepgram API error: {e}")
+        error_msg = f"Deepgram API error: {str(e)}"
 
-    for record in pending:
+    except Exception as e:
+        print(f"  ✗ [{contact_id}] Error: {e}")
+        error_msg = str(e)
 
-        # for testing lets do only 1 call
-        # if processed >= 10:
-        #     break
-        
-        processed += 1
-        contact_id = record["contactId"]
-        gcs_uri = record["gcs_uri"]
+    await results_queue.put(({"contactId": contact_id, "error_msg": error_msg}, False))
+    return False
 
-        print(f"\n{'=' * 70}")
-        print(f"[{processed}/{len(pending)}] Contact: {contact_id}")
-        print(f"  GCS: {gcs_uri}")
-        print("=" * 70)
 
+async def produce_records(rows, record_queue, consumer_count):
+    """
+    Feed pending rows into the record queue a page at a time, then send one
+    None sentinel per consumer. Page downloads run in a worker thread.
+    """
+    loop = asyncio.get_running_loop()
+    pages = iter(rows.pages)
+    index = 0
+    try:
+        while True:
+            page = await loop.run_in_executor(None, next, pages, None)
+            if page is None:
+                break
+            for row in page:
+                index += 1
+                await record_queue.put((index, {"contactId": row.contactId, "gcs_uri": row.gcs_uri}))
+    finally:
+        for _ in range(consumer_count):
+            await record_queue.put(None)
+
+
+async def sign_records(gcs_client, record_queue, signed_queue, results_queue, outcomes):
+    """
+    Generate signed URLs for records from the record queue and pass them on
+    to the Deepgram workers, until a None sentinel arrives. A record whose
+    URL can't be signed is saved as failed here.
+    """
+    while True:
+        item = await record_queue.get()
+        if item is None:
+            return
+        index, record = item
+        contact_id = record["contactId"]
         try:
-            # Step 1: Generate signed URL
-            print("  ⏳ Generating signed URL...")
-            signed_url = generate_signed_url(gcs_client, gcs_uri)
-            print("  ✓ Signed URL generated")
+            # Blocking GCS call, run in a thread
+            signed_url = await asyncio.to_thread(generate_signed_url, gcs_client, record["gcs_uri"])
+        except Exception as e:
+            print(f"  ✗ [{contact_id}] Error generating signed URL: {e}")
+            await results_queue.put(({"contactId": contact_id, "error_msg": str(e)}, False))
+            outcomes.append(False)
+            continue
+        await signed_queue.put((index, record, SignedAudioUrl(gcs_client, record["gcs_uri"], signed_url)))
+
+
+async def run_signers(gcs_client, record_queue, signed_queue, results_queue, outcomes, worker_count):
+    """Run the signer tasks, then send one None sentinel per Deepgram worker."""
+    try:
+        await asyncio.gather(*[
+            sign_records(gcs_client, record_queue, signed_queue, results_queue, outcomes)
+            for _ in range(SIGNER_TASKS)
+        ])
+    finally:
+        for _ in range(worker_count):
+            await signed_queue.put(None)
+
+
+async def transcription_worker(session, limiter, signed_queue, results_queue, total, outcomes):
+    """Process signed records from the signed queue until a None sentinel arrives."""
+    while True:
+        item = await signed_queue.get()
+        if item is None:
+            return
+        index, record, audio_url = item
+        outcomes.append(await process_record(session, limiter, results_queue, record, audio_url, index, total))
+
+
+async def main():
+    print("=" * 70)
+    print("CXone Transcription & Analysis Pipeline (Deepgram)")
+    print("=" * 70)
+    print(f"Model: {DEEPGRAM_MODEL}")
+    print(f"Concurrency: {MAX_CONCURRENT_CALLS}")
+    print(f"Table: {TRACKING_TABLE}")
+    print()
 
-            # Step 2: Call Deepgram API
-            print("  ⏳ Calling Deepgram API (transcription + analysis)...")
-            api_response = call_deepgram_api(signed_url)
-            print("  ✓ Deepgram API response received")
+    # Dedicated pool for the blocking signer, page-fetch and writer calls,
+    # rather than asyncio's default min(32, cpus + 4) threads
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="transcribe-io")
+    )
 
-            # Step 3: Parse response
-            parsed = parse_deepgram_response(api_response)
+    # Initialize clients
+    bq_client, gcs_client = init_clients()
 
-            # Show preview
-            transcript_preview = parsed["transcription"][:100]
-            print(f"  📝 Transcript: {transcript_preview}{'...' if len(parsed['transcription']) > 100 else ''}")
-            print(f"  📋 Summary: {parsed['summary'][:100]}{'...' if len(parsed['summary']) > 100 else ''}")
+    # Ensure new columns and the results table exist
+    ensure_new_columns(bq_client)
+    ensure_results_table(bq_client)
 
-            # Step 4: Update BigQuery
-            print("  ⏳ Updating BigQuery...")
-            update_bigquery_row(bq_client, contact_id, parsed, success=True)
+    # Apply transcripts an interrupted run saved but never merged, so those
+    # recordings aren't sent to Deepgram again (failures are simply retried)
+    run_started = datetime.now(timezone.utc)
+    recovered = merge_results(
+        bq_client, run_started - timedelta(days=RESULTS_LOOKBACK_DAYS), successes_only=True
+    )
+    if recovered:
+        print(f"✓ Applied {recovered} result(s) left over from a previous run")
 
-            success_count += 1
-            print(f"  ✅ Done!")
+    # Get pending transcriptions
+    # Set limit for testing, remove or set to None for full processing
+    pending = get_pending_transcriptions(bq_client, limit=10)
+    total = pending.total_rows
 
-        except requests.exceptions.HTTPError as e:
-            print(f"  ✗ Deepgram API error: {e}")
-            error_data = {"error": f"Deepgram API error: {str(e)}"}
-            update_bigquery_row(bq_client, contact_id, error_data, success=False)
-            failed_count += 1
+    print(f"\n✓ Found {total} recordings to transcribe.\n")
 
-        except Exception as e:
-            print(f"  ✗ Error: {e}")
-            error_data = {"error": str(e)}
-            update_bigquery_row(bq_client, contact_id, error_data, success=False)
-            failed_count += 1
+    if not total:
+        print("No pending transcriptions. Exiting.")
+        return
 
-        # Rate limiting
-        if processed < len(pending):
-            time.sleep(SLEEP_BETWEEN_CALLS)
+    # Three-stage pipeline connected by bounded queues:
+    #   producer (BigQuery pages) -> SIGNER_TASKS signers -> Deepgram workers
+    # Concurrency is the throttle: MAX_CONCURRENT_CALLS workers, each with one
+    # recording in flight
+    limiter = DeepgramRateLimiter(MAX_CONCURRENT_CALLS, DEEPGRAM_REQUESTS_PER_MINUTE)
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        ttl_dns_cache=DNS_CACHE_SECONDS,
+    )
+    headers = {
+        "Authorization": f"Token {DEEPGRAM_API_KEY}",
+        "Content-Type": "application/json",
+    }
+    record_queue = asyncio.Queue(maxsize=RECORD_QUEUE_SIZE)
+    signed_queue = asyncio.Queue(maxsize=SIGNED_QUEUE_SIZE)
+    results_queue = asyncio.Queue()
+    outcomes = []
+    writer_task = asyncio.create_task(results_writer(bq_client, results_queue))
+    try:
+        async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+            await asyncio.gather(
+                produce_records(pending, record_queue, SIGNER_TASKS),
+                run_signers(gcs_client, record_queue, signed_queue, results_queue, outcomes, MAX_CONCURRENT_CALLS),
+                *[
+                    transcription_worker(session, limiter, signed_queue, results_queue, total, outcomes)
+                    for _ in range(MAX_CONCURRENT_CALLS)
+                ],
+            )
+    finally:
+        await results_queue.put(None)
+        await writer_task
+        # Apply everything saved so far in one DML job, even if the run was
+        # interrupted
+        updated = await asyncio.to_thread(merge_results, bq_client, run_started)
+        print(f"  ✓ BigQuery tracking table updated for {updated} row(s)")
+
+    processed = len(outcomes)
+    success_count = sum(outcomes)
+    failed_count = processed - success_count
 
     # Final Summary
     print(f"\n{'=' * 70}")
@@ -547,4 +1029,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())